@@ -1,13 +1,113 @@
-from typing import Literal  
-from langchain_community.utilities.sql_database import SQLDatabase
+import functools
+import threading
+import time
+import uuid
+from typing import Annotated, Literal  
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_community.agent_toolkits import SQLDatabaseToolkit
-from langchain_core.messages import AIMessage
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import tool
 from langgraph.graph import END, START, MessagesState, StateGraph
 from langgraph.prebuilt import ToolNode
+from db_utilities import get_sql_database, get_schema_cache
+from sql_utilities import SQLValidator, get_plan_cache, render_plan, run_shaped_query
+from context_utilities import has_earlier_turns, prune_messages, token_usage
+from router_utilities import KeywordRouter, RouteDecision, PATIENT_DATA, GENERAL, log_route_decision
+from metrics_utilities import current_trace_id, get_tracer
+from snapshot_utilities import SNAPSHOT_MISS
+
+def add_token_usage(current, update):
+    """Reducer of AgentState.token_usage: appends entries, and None starts a new turn with an empty list."""
+    if update is None:
+        return []
+    return (current or []) + update
+
+class AgentState(MessagesState):
+    # Per-invocation input, so one compiled graph can serve every patient
+    patient_id: str
+    question: str
+    # Prefetched patient data that may answer the question without the SQL loop ("" if none)
+    snapshot: str
+    # Queries checked so far for the current question, capped by max_query_iterations
+    iterations: int
+    # Tokens in and out of every LLM call of the current turn, per node. Reset by every turn's
+    # input, so that a checkpointed conversation does not carry (and store) every earlier turn's usage
+    token_usage: Annotated[list, add_token_usage]
+
+# Tag on the LLM calls that produce user-facing answers
+ANSWER_TAG = "answer"
+
+# Compiled graphs, keyed by every agent setting the graph is built from (see DatabaseAgent._graph_key)
+# and shared across questions and patients
+_GRAPHS = {}
+_GRAPH_LOCK = threading.Lock()
+# Router used when none is given; shared, so that default agents share one compiled graph
+_DEFAULT_ROUTER = KeywordRouter()
+
+class LLMMetricsHandler(BaseCallbackHandler):
+    """Record a span for every LLM call made by the graph, with its node, tokens and payload sizes."""
+    def __init__(self, tracer):
+        self.tracer = tracer
+        self._calls = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        request_bytes = sum(len(str(message.content).encode("utf-8")) for batch in messages for message in batch)
+        node = (metadata or {}).get("langgraph_node", "llm")
+        self._calls[run_id] = {"start": time.perf_counter(), "started": time.time(), "node": node,
+                               "request_bytes": request_bytes, "first_token_seconds": None}
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        call = self._calls.get(run_id)
+        if call is not None and call["first_token_seconds"] is None:
+            call["first_token_seconds"] = time.perf_counter() - call["start"]
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        call = self._calls.pop(run_id, None)
+        if call is None:
+            return
+        message = getattr(response.generations[0][0], "message", None) if response.generations and response.generations[0] else None
+        usage = getattr(message, "usage_metadata", None) or {}
+        text = str(message.content) if message is not None else ""
+        attributes = {"input_tokens": usage.get("input_tokens", 0), "output_tokens": usage.get("output_tokens", 0),
+                      "request_bytes": call["request_bytes"], "response_bytes": len(text.encode("utf-8"))}
+        if call["first_token_seconds"] is not None:
+            attributes["first_token_seconds"] = call["first_token_seconds"]
+        self.tracer.record("llm", call["node"], time.perf_counter() - call["start"], started=call["started"], **attributes)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        call = self._calls.pop(run_id, None)
+        if call is not None:
+            self.tracer.record("llm", call["node"], time.perf_counter() - call["start"], started=call["started"],
+                               request_bytes=call["request_bytes"], error=f"{type(error).__name__}: {error}")
+
+def make_gemini_llm(gemini_key, **settings):
+    """
+    Create the Gemini chat model used by the agent.
+
+    Parameters:
+    - gemini_key: Gemini API key
+    - settings: Extra ChatGoogleGenerativeAI settings, e.g. rate_limiter or max_retries
+    """
+    return ChatGoogleGenerativeAI(model='gemini-2.0-flash',
+                                  verbose=True,
+                                  temperature=0,
+                                  google_api_key=gemini_key,
+                                  **settings)
+
+def traced_node(tracer, node):
+    """Wrap a graph node so every run is recorded as a span. The node's signature is kept for LangGraph."""
+    @functools.wraps(node)
+    def wrapper(*args, **kwargs):
+        with tracer.span("node", node.__name__):
+            return node(*args, **kwargs)
+    return wrapper
 
 class DatabaseAgent:
-    def __init__(self, patient_id, gemini_key, question):
+    def __init__(self, patient_id=None, gemini_key=None, question=None, db_uri=None, pool_settings=None, router=None,
+                 top_k=100, llm_check=False, debug=False, max_cell_chars=200, result_token_budget=2000,
+                 context_token_budget=8000, max_query_iterations=4, llm=None, db_rate_limiter=None,
+                 checkpointer=None):
         # Initial the database credentials
         self.host = 'db_host'
         self.port = 3306
@@ -17,89 +117,203 @@ class DatabaseAgent:
         self.patient_id = patient_id
         self.gemini_key = gemini_key
         self.question = question
+        # db_uri overrides the MySQL credentials above (e.g. a local SQLite stand-in)
+        self.db_uri = db_uri or f"mysql+pymysql://{self.user}:{self.password}@{self.host}:{self.port}/{self.database}"
+        self.pool_settings = pool_settings or {}
+        # Local router tried before the LLM; any object with classify(query) -> RouteDecision
+        self.router = router or _DEFAULT_ROUTER
+        # Row limit enforced on generated queries
+        self.top_k = top_k
+        # Also run the LLM-based query check (always used for dialects the local validator does not support)
+        self.llm_check = llm_check
+        # Print every message produced by the graph to stdout
+        self.debug = debug
+        # Query results sent back to the model are truncated per cell and capped at a token budget
+        self.max_cell_chars = max_cell_chars
+        self.result_token_budget = result_token_budget
+        # The message history sent to generate_query is pruned to this many tokens, and the
+        # generate_query -> run_query loop is stopped after max_query_iterations queries
+        self.context_token_budget = context_token_budget
+        self.max_query_iterations = max_query_iterations
+        # Chat model to use instead of Gemini (e.g. the scripted fake model in benchmark.py)
+        self.llm = llm
+        # Optional LangChain rate limiter acquired before every agent DB query (e.g. by batch runs)
+        self.db_rate_limiter = db_rate_limiter
+        # Optional LangGraph checkpointer (see checkpoint_utilities); questions asked with the same
+        # thread_id then continue one conversation, with the earlier questions, queries and results
+        self.checkpointer = checkpointer
 
     def connect_db(self):
-        mysql_uri = f"mysql+pymysql://{self.user}:{self.password}@{self.host}:{self.port}/{self.database}"
-        return SQLDatabase.from_uri(mysql_uri)
+        # Borrow the process-wide pooled database instead of reconnecting per question
+        return get_sql_database(self.db_uri, **self.pool_settings)
 
-    def create_agent(self):
+    def _graph_key(self):
+        # Every setting build_graph() reads must be part of the key, or agents with different settings
+        # would share the graph compiled by whichever agent came first. Objects are keyed by identity;
+        # the compiled graph keeps a reference to them, so their ids are not reused while it is cached.
+        def identity(value):
+            return id(value) if value is not None else None
+        return (self.gemini_key, self.db_uri, tuple(sorted(self.pool_settings.items())),
+                identity(self.llm), identity(self.router), identity(self.db_rate_limiter), identity(self.checkpointer),
+                self.top_k, self.llm_check, self.debug, self.max_cell_chars, self.result_token_budget,
+                self.context_token_budget, self.max_query_iterations)
+
+    def get_graph(self):
+        """Return the compiled agent graph for this agent's settings, compiling it once per process."""
+        cache_key = self._graph_key()
+        graph = _GRAPHS.get(cache_key)
+        if graph is not None:
+            return graph
+        with _GRAPH_LOCK:
+            graph = _GRAPHS.get(cache_key)
+            if graph is None:
+                graph = self.build_graph()
+                _GRAPHS[cache_key] = graph
+            return graph
+
+    def build_graph(self):
+        """Build and compile the agent graph. Prefer get_graph(), which caches the result."""
         # call gemini model
-        llm = ChatGoogleGenerativeAI(model='gemini-2.0-flash',
-                                    verbose=True,
-                                    temperature=0,
-                                    google_api_key=self.gemini_key)
+        llm = self.llm or make_gemini_llm(self.gemini_key)
+        # Calls whose output is shown to the user are tagged, so stream() only forwards their tokens
+        answer_llm = llm.with_config(tags=[ANSWER_TAG])
         db = self.connect_db()
+        # Table and column definitions are injected into generate_query from a cached snapshot,
+        # instead of list_tables / call_get_schema / get_schema round trips on every question
+        schema_cache = get_schema_cache(self.db_uri, **self.pool_settings)
+        # Validated SQL from earlier questions, with patient_id as a bind parameter
+        plan_cache = get_plan_cache(self.db_uri)
+        # Nodes, LLM calls and DB queries are timed into the process-wide tracer
+        tracer = get_tracer()
         
-        # Create the SQLDatabaseToolkit with the database and LLM
-        toolkit = SQLDatabaseToolkit(db=db, llm=llm)
-        # Create the agent with the tools
-        tools = toolkit.get_tools()
-        get_schema_tool = next(tool for tool in tools if tool.name == "sql_db_schema")
-        get_schema_node = ToolNode([get_schema_tool], name="get_schema")
-        run_query_tool = next(tool for tool in tools if tool.name == "sql_db_query")
+        def run_sql(query, parameters=None, name="query"):
+            # Rows are streamed from the database and encoded as compact, size-bounded CSV
+            if self.db_rate_limiter is not None:
+                self.db_rate_limiter.acquire()
+            with tracer.span("db", name, request_bytes=len(query.encode("utf-8"))) as attributes:
+                result = run_shaped_query(db._engine, query, parameters, max_rows=self.top_k,
+                                          max_cell_chars=self.max_cell_chars, token_budget=self.result_token_budget)
+                attributes["response_bytes"] = len(result.encode("utf-8"))
+                if result.startswith("Error"):
+                    attributes["error"] = result.splitlines()[0]
+            return result
+
+        @tool("sql_db_query")
+        def run_query_tool(query: str) -> str:
+            """Input to this tool is a detailed and correct SQL query, output is a result from the database.
+            If the query is not correct, an error message will be returned. If an error is returned,
+            rewrite the query, check the query, and try again. Results over the size budget are
+            truncated, with a note saying how many rows are shown and which cells were cut."""
+            return run_sql(query)
+
         run_query_node = ToolNode([run_query_tool], name="run_query")
        
         # Route the query to the appropriate chain
-        def determine_query_type(state: MessagesState):
+        def determine_query_type(state: AgentState):
             """Determine if the query is about patients or not."""
             messages = state["messages"]
             last_message = messages[-1]
             query = last_message.content
+            # Try the local router first; the LLM is only asked to route when it is not confident
+            decision = self.router.classify(query)
+            if decision.label == PATIENT_DATA:
+                log_route_decision(query, decision)
+                return {"messages": [AIMessage("list_tables")]}
+            if decision.label == GENERAL:
+                log_route_decision(query, decision)
+                system_answer_prompt = "You are a Health Informatice AI. Answer the question as briefly as you can."
+                response = answer_llm.invoke([{"role": "system", "content": system_answer_prompt}, {"role": "user", "content": query}])
+                return {"messages": [response], "token_usage": token_usage("determine_query_type", response)}
+
             # Use LLM to determine which tool to use
             system_route_prompt = f"""You are a Health Informatice AI. You will be given a user query and you must decide whether it is about patient's information, such as treament, pathology, phone number, address and so on.
             If the query is about patient's information, return "list_tables". If not, answer the question as briefly as you can.
             """
+            # In a continued conversation, the previous question and answer help to route follow-ups
+            # such as "and when was that one started?"
+            previous_turn = [message for message in messages[:-1] if isinstance(message, HumanMessage) or
+                             (isinstance(message, AIMessage) and not message.tool_calls and message.content != "list_tables")][-2:]
+            if previous_turn:
+                system_route_prompt += "\n            Previous turn of the conversation:\n" + "\n".join(
+                    f"            {message.type}: {message.content}" for message in previous_turn)
             system_message = {
                 "role": "system",
                 "content": system_route_prompt,
             }
 
             response = llm.invoke([system_message, {"role": "user", "content": query}])
+            usage = token_usage("determine_query_type", response)
             if "list_tables" in response.content :
-                return {"messages": [AIMessage("list_tables")]}
+                log_route_decision(query, RouteDecision(PATIENT_DATA, decision.confidence, "llm"))
+                return {"messages": [AIMessage("list_tables")], "token_usage": usage}
             else:
-                return {"messages": [response]}
+                log_route_decision(query, RouteDecision(GENERAL, decision.confidence, "llm"))
+                return {"messages": [response], "token_usage": usage}
 
-        def route_query(state: MessagesState) -> Literal[END, "list_tables"]:
+        def route_query(state: AgentState) -> Literal[END, "answer_from_snapshot"]:
             """Route the query to the appropriate tool based on the last message."""
             messages = state["messages"]
             last_message = messages[-1].content
             if "list_tables" in last_message:
-                return "list_tables"
+                return "answer_from_snapshot"
             else:
                 return END  
 
+        def answer_from_snapshot(state: AgentState):
+            """Answer with a single LLM call over the prefetched patient snapshot, when there is one."""
+            if not state.get("snapshot"):
+                return {"messages": []}
+            system_snapshot_prompt = f"""You are a Health Informatice AI answering a question about patient patient_id={state["patient_id"]}.
+            Use only the patient data below. If it does not contain the answer, reply with exactly "{SNAPSHOT_MISS}" and nothing else.
+
+            {state["snapshot"]}
+            """
+            # Not tagged as an answer, so a miss is never streamed to the user
+            response = llm.invoke([{"role": "system", "content": system_snapshot_prompt},
+                                   {"role": "user", "content": state["question"]}])
+            usage = token_usage("answer_from_snapshot", response)
+            if not isinstance(response.content, str) or SNAPSHOT_MISS in response.content or not response.content.strip():
+                # Fall back to the SQL agent loop
+                return {"messages": [], "token_usage": usage}
+            return {"messages": [response], "token_usage": usage}
+
+        def route_snapshot_answer(state: AgentState) -> Literal[END, "lookup_plan"]:
+            """Stop if the snapshot answered the question, otherwise continue with the SQL agent loop."""
+            if isinstance(state["messages"][-1], AIMessage) and state["messages"][-1].content == "list_tables":
+                return "lookup_plan"
+            return END
 
-        def list_tables(state: MessagesState):
-            """List the tables in the database."""
+        def lookup_plan(state: AgentState):
+            """Run a cached SQL plan for the same question intent, skipping query generation."""
+            # A follow-up ("and the one before?") depends on the earlier turns, not just its own words
+            if has_earlier_turns(state["messages"]):
+                return {"messages": []}
+            schema = schema_cache.get()
+            plan_cache.sync_schema(schema["fingerprint"] or schema_cache.version)
+            plan = plan_cache.get(state["question"], state["patient_id"])
+            if plan is None:
+                return {"messages": []}
+            template, quote = plan
+            result = run_sql(template, {"patient_id": state["patient_id"]}, name="cached_plan")
+            if result.startswith("Error"):
+                # A stale or broken plan falls back to normal query generation
+                plan_cache.invalidate()
+                return {"messages": []}
             tool_call = {
-                "name": "sql_db_list_tables",
-                "args": {},
-                "id": "abc123",
+                "name": run_query_tool.name,
+                "args": {"query": render_plan(template, quote, state["patient_id"])},
+                # Unique, as a checkpointed conversation can run cached plans on many turns
+                "id": f"cached_plan_{uuid.uuid4().hex[:8]}",
                 "type": "tool_call",
             }
             tool_call_message = AIMessage(content="", tool_calls=[tool_call])
+            tool_message = ToolMessage(content=result, tool_call_id=tool_call["id"], name=run_query_tool.name)
+            return {"messages": [tool_call_message, tool_message]}
 
-            list_tables_tool = next(tool for tool in tools if tool.name == "sql_db_list_tables")
-            tool_message = list_tables_tool.invoke(tool_call)
-            response = AIMessage(f"Available tables: {tool_message.content}")
-
-            return {"messages": [tool_call_message, tool_message, response]}
-
-
-        def call_get_schema(state: MessagesState):
-            """
-            Call the get_schema tool to get the schema of the database.
-            Note that LangChain enforces that all models accept `tool_choice="any"`
-            as well as `tool_choice=<string name of tool>`.
-            """
-            llm_with_tools = llm.bind_tools([get_schema_tool], tool_choice="any")
-            response = llm_with_tools.invoke(state["messages"])
-            return {"messages": [response]}
-
-        def generate_query(state: MessagesState):
+        def generate_query(state: AgentState):
             # Define the system prompt for generating queries
             # This prompt will be used to instruct the model on how to generate queries
+            schema = schema_cache.get()
             generate_query_system_prompt = """
                 You are an agent designed to interact with a SQL database.
                 Given an input question about patient patient_id={patient_id}, create a syntactically correct {dialect} query to run,
@@ -111,10 +325,17 @@ class DatabaseAgent:
                 examples in the database. Never query for all the columns from a specific table,
                 only ask for the relevant columns given the question.
                 DO NOT make any DML statements (INSERT, UPDATE, DELETE, DROP etc.) to the database.
+
+                Available tables: {tables}
+
+                Schema of the available tables:
+                {table_info}
             """.format(
                 dialect=db.dialect,
-                top_k=100,
-                patient_id=self.patient_id
+                top_k=self.top_k,
+                patient_id=state["patient_id"],
+                tables=", ".join(schema["tables"]),
+                table_info=schema["table_info"],
             )
             system_message = {
                 "role": "system",
@@ -122,13 +343,13 @@ class DatabaseAgent:
             }
             # We do not force a tool call here, to allow the model to
             # respond naturally when it obtains the solution.
-            llm_with_tools = llm.bind_tools([run_query_tool])
+            llm_with_tools = llm.bind_tools([run_query_tool]).with_config(tags=[ANSWER_TAG])
             response = llm_with_tools.invoke([system_message] + state["messages"])
 
-            return {"messages": [response]}
+            return {"messages": [response], "token_usage": token_usage("generate_query", response)}
 
-        def check_query(state: MessagesState):
-            """Check the query generated by the model."""
+        def llm_check_query(state: AgentState):
+            """Check the query generated by the model with the LLM."""
             check_query_system_prompt = """
                 You are a SQL expert with a strong attention to detail.
                 Double check the {dialect} query for common mistakes, including:
@@ -157,53 +378,203 @@ class DatabaseAgent:
             llm_with_tools = llm.bind_tools([run_query_tool], tool_choice="any")
             response = llm_with_tools.invoke([system_message, user_message])
             response.id = state["messages"][-1].id
-            return {"messages": [response]}
-        def should_continue(state: MessagesState) -> Literal[END, "check_query"]:
+            return response
+
+        def check_query(state: AgentState):
+            """Check the query generated by the model with the local validator."""
+            message = state["messages"][-1]
+            validator = SQLValidator(db.dialect, schema_cache.get()["columns"], top_k=self.top_k)
+            update = {"iterations": state.get("iterations", 0) + 1, "token_usage": []}
+            if self.llm_check or not validator.supported:
+                message = llm_check_query(state)
+                update["token_usage"] = token_usage("check_query", message)
+            tool_call = message.tool_calls[0]
+            result = validator.validate(tool_call["args"]["query"], state["patient_id"])
+            if not result.ok:
+                # Answer the tool call with the problems so generate_query can fix the query
+                error = "Error: the query was rejected by the validator:\n- " + "\n- ".join(result.errors)
+                return {**update, "messages": [ToolMessage(content=error, tool_call_id=tool_call["id"], name=run_query_tool.name)]}
+            checked_call = {**tool_call, "args": {**tool_call["args"], "query": result.sql}}
+            checked = AIMessage(content=message.content, tool_calls=[checked_call], id=state["messages"][-1].id)
+            return {**update, "messages": [checked]}
+
+        def route_checked_query(state: AgentState) -> Literal["run_query", "manage_context"]:
+            """Run a query that passed the check, or send the rejection back to generate_query."""
+            if isinstance(state["messages"][-1], ToolMessage):
+                return "manage_context"
+            return "run_query"
+
+        def run_query(state: AgentState, config: RunnableConfig):
+            """Execute the checked query and remember it as a plan if it succeeded (first turns only)."""
+            result = run_query_node.invoke(state, config)
+            tool_message = result["messages"][-1]
+            if not str(tool_message.content).startswith("Error") and not has_earlier_turns(state["messages"]):
+                query = state["messages"][-1].tool_calls[0]["args"]["query"]
+                plan_cache.put(state["question"], query, state["patient_id"])
+            return result
+
+        def manage_context(state: AgentState):
+            """Keep the history sent to generate_query within the context token budget."""
+            replacements, tokens_before, tokens_after = prune_messages(state["messages"], self.context_token_budget)
+            if replacements and self.debug:
+                print(f"Pruned {len(replacements)} message(s): {tokens_before} -> {tokens_after} tokens")
+            return {"messages": replacements}
+
+        def finalize(state: AgentState):
+            """Stop the query loop after max_query_iterations and answer from the results gathered so far."""
+            tool_call = state["messages"][-1].tool_calls[0]
+            limit_message = ToolMessage(
+                content=f"Error: the limit of {self.max_query_iterations} queries for this question was reached; the query was not run.",
+                tool_call_id=tool_call["id"], name=run_query_tool.name)
+            system_message = {
+                "role": "system",
+                "content": "Answer the user's question about the patient using only the query results above. "
+                           "If they are not enough, say briefly what could not be found and suggest a more specific question.",
+            }
+            response = answer_llm.invoke([system_message] + state["messages"] + [limit_message])
+            return {"messages": [limit_message, response], "token_usage": token_usage("finalize", response)}
+
+        def should_continue(state: AgentState) -> Literal[END, "check_query", "finalize"]:
             messages = state["messages"]
             last_message = messages[-1]
             if not last_message.tool_calls:
                 return END
+            elif state.get("iterations", 0) >= self.max_query_iterations:
+                return "finalize"
             else:
                 return "check_query"
 
 
-        builder = StateGraph(MessagesState)
-        builder.add_node(determine_query_type)
-        builder.add_node(list_tables)
-        builder.add_node(call_get_schema)
-        builder.add_node(get_schema_node, "get_schema")
-        builder.add_node(generate_query)
-        builder.add_node(check_query)
-        builder.add_node(run_query_node, "run_query")
+        builder = StateGraph(AgentState)
+        builder.add_node(traced_node(tracer, determine_query_type))
+        builder.add_node(traced_node(tracer, answer_from_snapshot))
+        builder.add_node(traced_node(tracer, lookup_plan))
+        builder.add_node(traced_node(tracer, generate_query))
+        builder.add_node(traced_node(tracer, check_query))
+        builder.add_node(traced_node(tracer, run_query))
+        builder.add_node(traced_node(tracer, manage_context))
+        builder.add_node(traced_node(tracer, finalize))
         
         builder.add_edge(START, "determine_query_type")
         builder.add_conditional_edges("determine_query_type", route_query)
-        builder.add_edge("list_tables", "call_get_schema")
-        builder.add_edge("call_get_schema", "get_schema")
-        builder.add_edge("get_schema", "generate_query")
+        builder.add_conditional_edges("answer_from_snapshot", route_snapshot_answer)
+        # History carried over from earlier questions is pruned before the first query is generated
+        builder.add_edge("lookup_plan", "manage_context")
         builder.add_conditional_edges(
             "generate_query",
             should_continue,
         )
-        builder.add_edge("check_query", "run_query")
-        builder.add_edge("run_query", "generate_query")
-
-        agent = builder.compile()
-        for step in agent.stream(
-            {"messages": [{"role": "user", "content": self.question}]},
-            stream_mode="values",
-        ):
-            step["messages"][-1].pretty_print()
-            
-        final_anwser = step["messages"][-1]
-        return final_anwser.content if isinstance(final_anwser, AIMessage) else final_anwser
+        builder.add_conditional_edges("check_query", route_checked_query)
+        builder.add_edge("run_query", "manage_context")
+        builder.add_edge("manage_context", "generate_query")
+        builder.add_edge("finalize", END)
+
+        return builder.compile(checkpointer=self.checkpointer)
+
+    def _graph_config(self, thread_id=None):
+        # LLM calls are timed by a callback, as they happen inside LangChain
+        config = {"callbacks": [LLMMetricsHandler(get_tracer())]}
+        if self.checkpointer is not None:
+            # Without a thread_id the question starts a conversation of its own
+            config["configurable"] = {"thread_id": thread_id or uuid.uuid4().hex}
+        return config
+
+    def _graph_input(self, question, patient_id, snapshot=None):
+        patient_id = self.patient_id if patient_id is None else patient_id
+        # The snapshot is only offered to the model for questions about topics it holds
+        usable = snapshot is not None and snapshot.patient_id == str(patient_id) and snapshot.covers(question)
+        return {"messages": [{"role": "user", "content": question}], "patient_id": str(patient_id), "question": question,
+                "snapshot": snapshot.text() if usable else "", "iterations": 0, "token_usage": None}
+
+    def _stream_events(self, mode, chunk, result):
+        """Convert one (mode, chunk) pair from the graph stream into events, tracking the final answer in result."""
+        if mode == "messages":
+            message, metadata = chunk
+            if ANSWER_TAG in metadata.get("tags", []) and isinstance(message.content, str) and message.content:
+                yield {"type": "token", "text": message.content, "message_id": message.id}
+            return
+        for node, update in chunk.items():
+            for message in (update or {}).get("messages", []):
+                if self.debug:
+                    message.pretty_print()
+                if isinstance(message, AIMessage) and not message.tool_calls:
+                    result["final"] = message.content
+            event = {"type": "node", "node": node}
+            if (update or {}).get("token_usage"):
+                event["usage"] = update["token_usage"]
+            yield event
+
+    def stream(self, question, patient_id=None, trace_id=None, snapshot=None, thread_id=None):
+        """
+        Answer a question, yielding events as they are produced.
+
+        Parameters:
+        - question: The user's question
+        - patient_id: The patient to scope the query to (defaults to self.patient_id)
+        - trace_id: Id of the chat turn the spans are recorded under
+        - snapshot: Optional PatientSnapshot; questions it covers are answered from it in one LLM call
+        - thread_id: Conversation to continue, when the agent has a checkpointer
+          (e.g. checkpoint_utilities.conversation_thread_id(session, patient_id))
+
+        Yields dicts with a 'type' key:
+        - {"type": "node", "node": name, "usage": [...]}: a graph node finished; usage lists the
+          tokens in/out of its LLM calls, when it made any
+        - {"type": "token", "text": text, "message_id": id}: a token of a user-facing answer;
+          tokens of a new message_id replace the previous message (e.g. text before a tool call)
+        - {"type": "final", "text": answer}: the final answer, always the last event
+
+        Spans for the nodes, LLM calls and DB queries are recorded in get_tracer() under trace_id
+        (by default the trace already active in the caller, or a new one).
+        """
+        result = {"final": None}
+        with get_tracer().trace(trace_id or current_trace_id()):
+            for mode, chunk in self.get_graph().stream(self._graph_input(question, patient_id, snapshot), self._graph_config(thread_id),
+                                                       stream_mode=["updates", "messages"]):
+                yield from self._stream_events(mode, chunk, result)
+        yield {"type": "final", "text": result["final"]}
+
+    async def astream(self, question, patient_id=None, trace_id=None, snapshot=None, thread_id=None):
+        """Async version of stream(). Blocking DB and tool calls run on the event loop's default executor."""
+        result = {"final": None}
+        with get_tracer().trace(trace_id or current_trace_id()):
+            async for mode, chunk in self.get_graph().astream(self._graph_input(question, patient_id, snapshot), self._graph_config(thread_id),
+                                                              stream_mode=["updates", "messages"]):
+                for event in self._stream_events(mode, chunk, result):
+                    yield event
+        yield {"type": "final", "text": result["final"]}
+
+    def ask(self, question, patient_id=None, snapshot=None, thread_id=None):
+        """
+        Answer a question about a patient using the shared compiled graph.
+
+        Parameters:
+        - question: The user's question
+        - patient_id: The patient to scope the query to (defaults to self.patient_id)
+        - snapshot: Optional PatientSnapshot to answer from
+        - thread_id: Conversation to continue, when the agent has a checkpointer
+
+        Returns:
+        - The final answer text
+        """
+        for event in self.stream(question, patient_id, snapshot=snapshot, thread_id=thread_id):
+            if event["type"] == "final":
+                return event["text"]
+
+    async def ainvoke(self, question, patient_id=None, snapshot=None, thread_id=None):
+        """Async version of ask()."""
+        async for event in self.astream(question, patient_id, snapshot=snapshot, thread_id=thread_id):
+            if event["type"] == "final":
+                return event["text"]
+
+    def create_agent(self):
+        return self.ask(self.question, self.patient_id)
 
 def main():
     patient_id = 143
     gemini_key = "your_gemini_api_key_here"
     question = "What treaments the patient has recently?"
-    agent = DatabaseAgent(patient_id, gemini_key, question)
-    final_answer = agent.create_agent()
+    agent = DatabaseAgent(gemini_key=gemini_key)
+    final_answer = agent.ask(question, patient_id)
     print(final_answer)
 
 if __name__ == "__main__":
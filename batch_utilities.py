@@ -0,0 +1,236 @@
+"""
+Batch question answering over many patients.
+
+Reads (patient_id, question) pairs from a JSONL or CSV file, answers them
+concurrently with DatabaseAgent under an adaptive Gemini rate limit and a DB
+query rate limit, and appends one JSON line per result to the output file.
+Re-running with the same output file skips the questions already answered.
+
+Usage:
+    python batch_utilities.py questions.jsonl answers.jsonl --concurrency 8 --llm-rps 2 --db-rps 20
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import time
+from langchain_core.rate_limiters import InMemoryRateLimiter
+from agent_utilities import DatabaseAgent, make_gemini_llm
+from metrics_utilities import percentile
+
+try:
+    from google.api_core.exceptions import ResourceExhausted
+except ImportError:
+    ResourceExhausted = None
+
+class AdaptiveRateLimiter(InMemoryRateLimiter):
+    """
+    Token bucket whose rate adapts to throttling.
+
+    The rate is halved on every backoff() (down to min_requests_per_second)
+    and raised by recovery_step on every recover() (up to the configured
+    rate), so the batch settles just below the quota it is actually given.
+    Can be passed as the rate_limiter of a LangChain chat model.
+    """
+    def __init__(self, requests_per_second, min_requests_per_second=None, recovery_step=None, max_bucket_size=1):
+        super().__init__(requests_per_second=requests_per_second, check_every_n_seconds=0.05,
+                         max_bucket_size=max_bucket_size)
+        self.max_requests_per_second = requests_per_second
+        self.min_requests_per_second = min_requests_per_second or requests_per_second / 16
+        self.recovery_step = recovery_step or requests_per_second / 20
+        self.backoffs = 0
+
+    def backoff(self):
+        with self._consume_lock:
+            self.requests_per_second = max(self.min_requests_per_second, self.requests_per_second / 2)
+            # Drop saved-up tokens so the lower rate applies straight away
+            self.available_tokens = 0.0
+            self.backoffs += 1
+
+    def recover(self):
+        with self._consume_lock:
+            self.requests_per_second = min(self.max_requests_per_second, self.requests_per_second + self.recovery_step)
+
+def is_rate_limited(error):
+    """
+    True if an exception from Gemini means the request was throttled.
+
+    Only the exception type (ResourceExhausted) and HTTP status code (429) are
+    trusted, never the message text: a DB error mentioning "quota" or "429" is
+    not throttling. Wrapped exceptions are checked through their causes.
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if ResourceExhausted is not None and isinstance(error, ResourceExhausted):
+            return True
+        if getattr(error, "status_code", None) == 429 or getattr(error, "code", None) == 429:
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+def read_questions(path):
+    """
+    Read batch questions from a JSONL or CSV file.
+
+    Every row needs patient_id and question; id is optional and defaults to the
+    row number. Ids identify answered questions when a run is resumed.
+
+    Returns:
+    - List of {"id", "patient_id", "question"} dicts
+    """
+    with open(path, newline="", encoding="utf-8") as questions_file:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(questions_file))
+        else:
+            rows = [json.loads(line) for line in questions_file if line.strip()]
+    questions = []
+    for index, row in enumerate(rows, start=1):
+        if not row.get("question") or row.get("patient_id") in (None, ""):
+            print(f"Skipping row {index}: patient_id and question are required")
+            continue
+        questions.append({"id": str(row.get("id") or index), "patient_id": str(row["patient_id"]),
+                          "question": row["question"]})
+    return questions
+
+def answered_ids(output_path):
+    """Return the ids already answered in an output file, so that an interrupted run can resume."""
+    ids = set()
+    if not os.path.exists(output_path):
+        return ids
+    with open(output_path, encoding="utf-8") as output_file:
+        for line in output_file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may be cut off if the previous run was killed mid-write
+                continue
+            if result.get("error") is None:
+                ids.add(str(result["id"]))
+    return ids
+
+class BatchRunner:
+    """
+    Answer many questions concurrently, under Gemini and DB rate limits.
+
+    At most concurrency questions run at once. Every Gemini call and every
+    agent DB query first takes a token from its rate limiter. A question
+    throttled by Gemini (429 / RESOURCE_EXHAUSTED) halves the Gemini rate,
+    waits with exponential backoff and is retried, up to max_attempts times;
+    the rate creeps back up as questions succeed. DB errors are returned to
+    the model as text by the agent, so the DB rate stays fixed.
+    """
+    def __init__(self, gemini_key=None, db_uri=None, concurrency=8, llm_rps=2.0, db_rps=20.0, max_attempts=5,
+                 backoff_seconds=2.0, llm=None, **agent_settings):
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.llm_limiter = AdaptiveRateLimiter(llm_rps)
+        self.db_limiter = InMemoryRateLimiter(requests_per_second=db_rps, check_every_n_seconds=0.01,
+                                              max_bucket_size=max(1, int(db_rps)))
+        # Retries are left to the scheduler, so that throttling is seen and the rate adapted
+        llm = llm or make_gemini_llm(gemini_key, rate_limiter=self.llm_limiter, max_retries=1)
+        self.agent = DatabaseAgent(gemini_key=gemini_key, db_uri=db_uri, llm=llm, db_rate_limiter=self.db_limiter,
+                                   **agent_settings)
+
+    async def _answer(self, item):
+        started = time.perf_counter()
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                answer = await self.agent.ainvoke(item["question"], item["patient_id"])
+            except Exception as e:
+                if not is_rate_limited(e) or attempt == self.max_attempts:
+                    return {**item, "answer": None, "error": f"{type(e).__name__}: {e}", "attempts": attempt,
+                            "seconds": time.perf_counter() - started}
+                self.llm_limiter.backoff()
+                await asyncio.sleep(self.backoff_seconds * 2 ** (attempt - 1))
+                continue
+            self.llm_limiter.recover()
+            return {**item, "answer": answer, "error": None, "attempts": attempt,
+                    "seconds": time.perf_counter() - started}
+
+    async def arun(self, questions, output_path):
+        """
+        Answer the questions not yet in output_path, appending a JSON line per result as it finishes.
+
+        Returns:
+        - Throughput summary dict
+        """
+        done = answered_ids(output_path)
+        pending = [item for item in questions if item["id"] not in done]
+        queue = asyncio.Queue()
+        for item in pending:
+            queue.put_nowait(item)
+        results = []
+        started = time.perf_counter()
+
+        with open(output_path, "a+", encoding="utf-8") as output_file:
+            # Start on a new line if the previous run was killed in the middle of one
+            if output_file.tell() > 0:
+                output_file.seek(output_file.tell() - 1)
+                if output_file.read(1) != "\n":
+                    output_file.write("\n")
+            async def worker():
+                while True:
+                    try:
+                        item = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    result = await self._answer(item)
+                    results.append(result)
+                    # Written and flushed per result, so an interrupted run loses nothing it finished
+                    output_file.write(json.dumps(result, default=str) + "\n")
+                    output_file.flush()
+                    if len(results) % 50 == 0:
+                        print(f"{len(results)}/{len(pending)} answered")
+
+            await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(pending)) or 1)))
+
+        elapsed = time.perf_counter() - started
+        latencies = [result["seconds"] for result in results]
+        return {
+            "questions": len(questions),
+            "skipped": len(questions) - len(pending),
+            "answered": sum(result["error"] is None for result in results),
+            "failed": sum(result["error"] is not None for result in results),
+            "retries": sum(result["attempts"] - 1 for result in results),
+            "seconds": elapsed,
+            "questions_per_second": len(results) / elapsed if elapsed else 0.0,
+            "p50_seconds": percentile(latencies, 50),
+            "p95_seconds": percentile(latencies, 95),
+            "llm_backoffs": self.llm_limiter.backoffs,
+            "final_llm_rps": self.llm_limiter.requests_per_second,
+        }
+
+    def run(self, questions, output_path):
+        """Synchronous version of arun()."""
+        return asyncio.run(self.arun(questions, output_path))
+
+def print_summary(summary):
+    print(f"Answered {summary['answered']} and failed {summary['failed']} of {summary['questions']} questions "
+          f"({summary['skipped']} already done) in {summary['seconds']:.1f} s: "
+          f"{summary['questions_per_second']:.2f} questions/s, p50 {summary['p50_seconds']:.2f} s, "
+          f"p95 {summary['p95_seconds']:.2f} s, {summary['retries']} retries, "
+          f"{summary['llm_backoffs']} Gemini backoffs, "
+          f"final Gemini rate {summary['final_llm_rps']:.2f} req/s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a file of (patient_id, question) pairs with the database agent.")
+    parser.add_argument("questions", help="JSONL or CSV file with patient_id, question and optional id columns")
+    parser.add_argument("output", help="JSONL file the answers are appended to; re-run to resume")
+    parser.add_argument("--gemini-key", default=os.environ.get("GEMINI_API_KEY"))
+    parser.add_argument("--db-uri", default=os.environ.get("PATIENT_DB_URI"))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--llm-rps", type=float, default=2.0, help="Gemini requests per second to start from")
+    parser.add_argument("--db-rps", type=float, default=20.0, help="Agent DB queries per second")
+    parser.add_argument("--max-attempts", type=int, default=5)
+    args = parser.parse_args()
+    if not args.gemini_key:
+        parser.error("a Gemini API key is required (--gemini-key or GEMINI_API_KEY)")
+    runner = BatchRunner(gemini_key=args.gemini_key, db_uri=args.db_uri, concurrency=args.concurrency,
+                         llm_rps=args.llm_rps, db_rps=args.db_rps, max_attempts=args.max_attempts)
+    print_summary(runner.run(read_questions(args.questions), args.output))
+
+if __name__ == "__main__":
+    main()
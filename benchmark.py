@@ -0,0 +1,354 @@
+"""
+Offline benchmark for the patient query assistant.
+
+Runs DatabaseAgent and the voice pipeline against a scripted fake chat model,
+a synthetic SQLite patient database and stub transcription/TTS clients, so it
+needs no network, API keys, MySQL or AWS. Results are repeatable for a seed.
+
+Usage:
+    python benchmark.py --patients 10000 --questions 200 --llm-latency 0.05
+"""
+import argparse
+import io
+import json
+import os
+import random
+import re
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import Field
+from sqlalchemy import event
+from agent_utilities import DatabaseAgent
+from db_utilities import get_engine
+from llm_utilities import SpeechPipeline, transcribe_audio
+from metrics_utilities import get_tracer, percentile
+from snapshot_utilities import SNAPSHOT_MISS, SnapshotStore
+from sql_utilities import estimate_tokens, get_plan_cache
+
+FIRST_NAMES = ["Kate", "Daniel", "Emily", "Alexander", "Aiden", "Luna", "Olivia", "Noah", "Mia", "Liam"]
+MIDDLE_NAMES = ["Ann", "John", "George", "Kevin", "David", "Michael", "Nicholas", "Juan", "Timothy", "Stephen"]
+LAST_NAMES = ["Evans", "Thomas", "Walker", "White", "Jackson", "Lewis", "Baker", "Green", "Flores", "Wright"]
+TREATMENTS = ["Chemotherapy", "Radiotherapy", "Immunotherapy", "Physiotherapy", "Insulin", "Statins", "Surgery"]
+DIAGNOSES = ["Benign lesion", "Adenocarcinoma", "Inflammation", "Fibrosis", "No abnormality detected"]
+
+DEFAULT_QUESTIONS = [
+    "What treatments has the patient had recently?",
+    "What is the patient's phone number?",
+    "Show the latest pathology report for this patient.",
+    "What is the patient's address?",
+    "When did the patient start their most recent treatment?",
+    "What was the patient diagnosed with?",
+    "Hello, who are you?",
+]
+
+# Scripted SQL per topic; {patient_id} is filled from the generate_query system prompt
+SCRIPTED_QUERIES = [
+    (("treatment", "therapy", "medication"),
+     "SELECT name, start_date FROM treatments WHERE patient_id = {patient_id} ORDER BY start_date DESC LIMIT 10"),
+    (("pathology", "diagnos", "report"),
+     "SELECT report_date, diagnosis, notes FROM pathology WHERE patient_id = {patient_id} ORDER BY report_date DESC LIMIT 5"),
+    (("phone", "address", "contact", "email"),
+     "SELECT full_name, phone, address FROM patients WHERE patient_id = {patient_id}"),
+]
+
+class FakeChatModel(BaseChatModel):
+    """
+    Scripted stand-in for ChatGoogleGenerativeAI.
+
+    Answers the routing prompt, issues a tool call for the SQL query that
+    matches the question's topic, then answers from the tool result. Supports
+    bind_tools, token streaming and configurable latency, and counts calls and
+    approximate tokens in stats.
+    """
+    latency: float = 0.0            # seconds before the first token
+    token_latency: float = 0.0      # seconds between streamed tokens
+    stats: dict = Field(default_factory=lambda: {"calls": 0, "input_tokens": 0, "output_tokens": 0})
+
+    @property
+    def _llm_type(self):
+        return "fake-scripted"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _reply(self, messages):
+        system = messages[0].content if messages and messages[0].type == "system" else ""
+        question = next((message.content for message in reversed(messages) if message.type == "human"), "")
+        if "decide whether" in system:
+            if any(word in question.lower() for topic, _ in SCRIPTED_QUERIES for word in topic):
+                return AIMessage("list_tables")
+            return AIMessage("I'm an assistant for patient records.")
+        if "Use only the patient data below" in system:
+            # Answer from the first data row of the snapshot, or report a miss for unknown topics
+            if not any(word in question.lower() for topic, _ in SCRIPTED_QUERIES for word in topic):
+                return AIMessage(SNAPSHOT_MISS)
+            rows = [line.strip() for line in system.split("## ", 2)[1].splitlines()[2:3]]
+            return AIMessage(f"According to the patient summary: {rows[0] if rows else 'no rows'}.")
+        if "agent designed to interact with a SQL database" in system:
+            last = messages[-1]
+            if isinstance(last, ToolMessage) and not str(last.content).startswith("Error"):
+                first_row = (str(last.content).splitlines()[1:2] or ["no rows"])[0]
+                return AIMessage(f"Based on the record, the result is: {first_row}.")
+            patient_id = re.search(r"patient_id=(\S+),", system).group(1)
+            query = next((sql for topic, sql in SCRIPTED_QUERIES if any(word in question.lower() for word in topic)),
+                         SCRIPTED_QUERIES[0][1])
+            return AIMessage("", tool_calls=[{"name": "sql_db_query", "args": {"query": query.format(patient_id=patient_id)},
+                                              "id": f"call_{uuid.uuid4().hex[:8]}", "type": "tool_call"}])
+        return AIMessage("I'm an assistant for patient records. Ask me about the selected patient.")
+
+    def _record(self, messages, reply):
+        input_tokens = sum(estimate_tokens(str(message.content)) for message in messages)
+        output_tokens = estimate_tokens(str(reply.content) + json.dumps([call["args"] for call in reply.tool_calls]))
+        self.stats["calls"] += 1
+        self.stats["input_tokens"] += input_tokens
+        self.stats["output_tokens"] += output_tokens
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        reply = self._reply(messages)
+        reply.usage_metadata = self._record(messages, reply)
+        return ChatResult(generations=[ChatGeneration(message=reply)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        reply = self._reply(messages)
+        usage = self._record(messages, reply)
+        if reply.tool_calls:
+            tool_call_chunks = [{"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": index}
+                                for index, call in enumerate(reply.tool_calls)]
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=tool_call_chunks,
+                                                             usage_metadata=usage))
+            return
+        words = reply.content.split(" ")
+        for index, word in enumerate(words):
+            if index:
+                time.sleep(self.token_latency)
+            text = word if index == len(words) - 1 else word + " "
+            chunk = ChatGenerationChunk(message=AIMessageChunk(
+                content=text, usage_metadata=usage if index == len(words) - 1 else None))
+            if run_manager:
+                run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
+
+class _StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+class _StubModels:
+    def __init__(self, latency, transcript):
+        self.latency = latency
+        self.transcript = transcript
+
+    def generate_content(self, model, contents, config=None):
+        time.sleep(self.latency)
+        return _StubResponse(self.transcript)
+
+class StubGenaiClient:
+    """Stand-in for google.genai.Client that returns a fixed transcript."""
+    def __init__(self, latency=0.0, transcript="What treatments has the patient had recently?"):
+        self.models = _StubModels(latency, transcript)
+
+class StubPollyClient:
+    """Stand-in for the boto3 Polly client that returns fake MP3 bytes proportional to the text."""
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+
+    def synthesize_speech(self, Text, VoiceId, Engine, OutputFormat, TextType):
+        time.sleep(self.latency)
+        self.calls += 1
+        return {"AudioStream": io.BytesIO(b"\xff\xfb\x90\x00" * max(1, len(Text)))}
+
+def make_synthetic_db(path, patients=1000, treatments_per_patient=5, reports_per_patient=2, seed=0):
+    """
+    Create a synthetic SQLite patient database.
+
+    Tables: patients, treatments and pathology (with long free-text notes),
+    indexed on patient_id and on (full_name, patient_id) for the directory.
+    """
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        CREATE TABLE patients (patient_id INTEGER PRIMARY KEY, full_name TEXT, phone TEXT, address TEXT);
+        CREATE TABLE treatments (treatment_id INTEGER PRIMARY KEY, patient_id INTEGER, name TEXT, start_date TEXT);
+        CREATE TABLE pathology (report_id INTEGER PRIMARY KEY, patient_id INTEGER, report_date TEXT,
+                                diagnosis TEXT, notes TEXT);
+    """)
+    connection.executemany("INSERT INTO patients VALUES (?, ?, ?, ?)", (
+        (patient_id,
+         f"{rng.choice(FIRST_NAMES)} {rng.choice(MIDDLE_NAMES)} {rng.choice(LAST_NAMES)}",
+         f"555-{rng.randint(1000, 9999)}",
+         f"{rng.randint(1, 999)} Main Street")
+        for patient_id in range(1, patients + 1)))
+    connection.executemany("INSERT INTO treatments (patient_id, name, start_date) VALUES (?, ?, ?)", (
+        (patient_id, rng.choice(TREATMENTS), f"20{rng.randint(15, 25)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}")
+        for patient_id in range(1, patients + 1) for _ in range(treatments_per_patient)))
+    connection.executemany("INSERT INTO pathology (patient_id, report_date, diagnosis, notes) VALUES (?, ?, ?, ?)", (
+        (patient_id, f"20{rng.randint(15, 25)}-{rng.randint(1, 12):02d}-01", rng.choice(DIAGNOSES),
+         " ".join(rng.choice(DIAGNOSES).lower() for _ in range(rng.randint(50, 300))))
+        for patient_id in range(1, patients + 1) for _ in range(reports_per_patient)))
+    connection.executescript("""
+        CREATE INDEX ix_treatments_patient_id ON treatments (patient_id);
+        CREATE INDEX ix_pathology_patient_id ON pathology (patient_id);
+        CREATE INDEX ix_patients_full_name_patient_id ON patients (full_name, patient_id);
+    """)
+    connection.commit()
+    connection.close()
+    return path
+
+def _peak_rss_mb():
+    """Peak resident set size of the process so far, in MB (None if the platform does not report it)."""
+    try:
+        import resource
+    except ImportError:
+        # Windows has no resource module; psutil reports the peak working set there
+        try:
+            import psutil
+        except ImportError:
+            return None
+        peak = getattr(psutil.Process().memory_info(), "peak_wset", None)
+        return peak / 1024 / 1024 if peak else None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+def run_benchmark(patients=1000, questions=50, llm_latency=0.0, token_latency=0.0, tts_latency=0.0,
+                  seed=0, question_texts=None, voice=True, snapshot=False, db_path=None):
+    """
+    Run the benchmark and return a report dict.
+
+    Parameters:
+    - patients: Size of the synthetic database
+    - questions: Number of (patient, question) pairs to ask
+    - llm_latency / token_latency: Fake model first-token and inter-token latency (seconds)
+    - tts_latency: Stub Polly latency per request (seconds)
+    - seed: Random seed for the database and the question mix
+    - question_texts: Questions to sample from (defaults to DEFAULT_QUESTIONS)
+    - voice: Also run stub transcription and the sentence-chunked TTS pipeline
+    - snapshot: Prefetch a patient snapshot before each question and let the agent answer from it
+    - db_path: Where to create the SQLite database (a temporary file by default)
+    """
+    rng = random.Random(seed)
+    get_tracer().clear()
+    db_path = db_path or os.path.join(tempfile.mkdtemp(prefix="benchmark_"), "patients.db")
+    make_synthetic_db(db_path, patients=patients, seed=seed)
+    db_uri = f"sqlite:///{db_path}"
+
+    round_trips = {"count": 0}
+    event.listen(get_engine(db_uri), "before_cursor_execute",
+                 lambda *args: round_trips.__setitem__("count", round_trips["count"] + 1))
+
+    llm = FakeChatModel(latency=llm_latency, token_latency=token_latency)
+    agent = DatabaseAgent(gemini_key="benchmark", db_uri=db_uri, llm=llm)
+    genai_client = StubGenaiClient(latency=llm_latency)
+    polly_client = StubPollyClient(latency=tts_latency)
+    snapshots = SnapshotStore(db_uri) if snapshot else None
+
+    started = time.perf_counter()
+    agent.get_graph()
+    compile_seconds = time.perf_counter() - started
+
+    question_texts = question_texts or DEFAULT_QUESTIONS
+    transcribe = voice
+    latencies, first_token_latencies, voice_latencies = [], [], []
+    per_question = []
+    for _ in range(questions):
+        patient_id = rng.randint(1, patients)
+        question = rng.choice(question_texts)
+        patient_snapshot = None
+        if snapshots is not None:
+            # Selection-time prefetch is not counted in the question latency
+            snapshots.prefetch(patient_id)
+            patient_snapshot = snapshots.get(patient_id, wait=10)
+        calls_before, tokens_before = llm.stats["calls"], (llm.stats["input_tokens"], llm.stats["output_tokens"])
+        trips_before = round_trips["count"]
+
+        started = time.perf_counter()
+        if transcribe:
+            # The stub echoes the sampled question, so only the transcription overhead is measured
+            genai_client.models.transcript = question
+            try:
+                question = transcribe_audio(genai_client, b"RIFF0000WAVE", mime_type="audio/wav")
+            except ImportError:
+                print("google-genai is not installed; skipping the transcription step.")
+                transcribe = False
+        speech = SpeechPipeline(polly_client) if voice else None
+        first_token = None
+        for agent_event in agent.stream(question, patient_id, snapshot=patient_snapshot):
+            if agent_event["type"] == "token":
+                first_token = first_token or time.perf_counter() - started
+                if speech:
+                    speech.feed(agent_event["text"])
+            elif agent_event["type"] == "final":
+                answer = agent_event["text"]
+        answered = time.perf_counter() - started
+        if speech:
+            if first_token is None:
+                speech.feed(answer or "")
+            speech.close()
+            speech.audio()
+            voice_latencies.append(time.perf_counter() - started)
+
+        latencies.append(answered)
+        first_token_latencies.append(first_token if first_token is not None else answered)
+        per_question.append({
+            "llm_calls": llm.stats["calls"] - calls_before,
+            "input_tokens": llm.stats["input_tokens"] - tokens_before[0],
+            "output_tokens": llm.stats["output_tokens"] - tokens_before[1],
+            "db_round_trips": round_trips["count"] - trips_before,
+        })
+
+    def summary(values):
+        return {"p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99),
+                "mean": statistics.fmean(values) if values else 0.0}
+
+    report = {
+        "patients": patients,
+        "questions": questions,
+        "graph_compile_seconds": compile_seconds,
+        "latency_seconds": summary(latencies),
+        "first_token_seconds": summary(first_token_latencies),
+        "llm_calls_per_question": statistics.fmean(item["llm_calls"] for item in per_question),
+        "input_tokens_per_question": statistics.fmean(item["input_tokens"] for item in per_question),
+        "output_tokens_per_question": statistics.fmean(item["output_tokens"] for item in per_question),
+        "db_round_trips_per_question": statistics.fmean(item["db_round_trips"] for item in per_question),
+        "plan_cache": get_plan_cache(db_uri).stats(),
+        "peak_rss_mb": _peak_rss_mb(),
+        # Time per graph node, LLM call, DB query and synthesis step, from the tracer
+        "steps": {f"{row['kind']}:{row['name']}": {"count": row["count"], "mean_seconds": row["mean_seconds"]}
+                  for row in get_tracer().summary()},
+    }
+    if voice:
+        report["voice_turn_seconds"] = summary(voice_latencies)
+        report["polly_calls"] = polly_client.calls
+        report["transcription_measured"] = transcribe
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark with a fake LLM and a synthetic patient database.")
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--questions", type=int, default=50)
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Fake model first-token latency in seconds")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Fake model inter-token latency in seconds")
+    parser.add_argument("--tts-latency", type=float, default=0.0, help="Stub Polly latency in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-voice", action="store_true", help="Skip stub transcription and speech synthesis")
+    parser.add_argument("--snapshot", action="store_true", help="Answer from prefetched patient snapshots when possible")
+    args = parser.parse_args()
+    report = run_benchmark(patients=args.patients, questions=args.questions, llm_latency=args.llm_latency,
+                           token_latency=args.token_latency, tts_latency=args.tts_latency, seed=args.seed,
+                           voice=not args.no_voice, snapshot=args.snapshot)
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+# Local SQLite file holding every conversation's graph state. It contains patient data
+# (questions, queries and results), so conversations are deleted once they go idle.
+DEFAULT_CHECKPOINT_PATH = "checkpoints.sqlite"
+# Conversations untouched for this long are deleted, checked at most every PRUNE_INTERVAL seconds
+DEFAULT_RETENTION_SECONDS = 7 * 24 * 3600
+PRUNE_INTERVAL = 3600
+
+class ThreadedSqliteSaver(SqliteSaver):
+    """
+    SqliteSaver that also supports the async graph API.
+
+    SqliteSaver only implements the sync methods (and AsyncSqliteSaver is tied
+    to one event loop), while the agent is run both from sync code and from the
+    shared question executor's loop. The async methods run the sync ones on a
+    worker thread; SqliteSaver already serializes access to the connection.
+    It also records when each conversation was last written to, so that idle
+    conversations can be deleted with prune().
+    """
+    # time.time() of the last prune()
+    last_pruned = 0.0
+
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        checkpoints = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for checkpoint in checkpoints:
+            yield checkpoint
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    def setup(self):
+        if self.is_setup:
+            return
+        super().setup()
+        # When each conversation was last written to, for retention
+        self.conn.execute("CREATE TABLE IF NOT EXISTS thread_activity (thread_id TEXT PRIMARY KEY, updated REAL NOT NULL)")
+        self.conn.commit()
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        saved = super().put(config, checkpoint, metadata, new_versions)
+        with self.cursor() as cursor:
+            cursor.execute("INSERT OR REPLACE INTO thread_activity (thread_id, updated) VALUES (?, ?)",
+                           (str(config["configurable"]["thread_id"]), time.time()))
+        return saved
+
+    def delete_thread(self, thread_id):
+        """Delete every checkpoint and pending write of a conversation."""
+        with self.cursor() as cursor:
+            for table in ("checkpoints", "writes", "thread_activity"):
+                cursor.execute(f"DELETE FROM {table} WHERE thread_id = ?", (str(thread_id),))
+
+    def prune(self, max_age=DEFAULT_RETENTION_SECONDS):
+        """
+        Delete the conversations that have not been written to for max_age seconds.
+
+        Returns:
+        - Number of conversations deleted
+        """
+        now = time.time()
+        with self.cursor() as cursor:
+            # Conversations saved before activity was tracked start their retention period now
+            cursor.execute("INSERT OR IGNORE INTO thread_activity (thread_id, updated) "
+                           "SELECT DISTINCT thread_id, ? FROM checkpoints", (now,))
+            expired = [row[0] for row in cursor.execute("SELECT thread_id FROM thread_activity WHERE updated < ?",
+                                                        (now - max_age,))]
+            for table in ("checkpoints", "writes", "thread_activity"):
+                cursor.executemany(f"DELETE FROM {table} WHERE thread_id = ?", [(thread_id,) for thread_id in expired])
+        self.last_pruned = now
+        return len(expired)
+
+_CHECKPOINTERS = {}
+_CHECKPOINTER_LOCK = threading.Lock()
+
+def get_checkpointer(path=DEFAULT_CHECKPOINT_PATH, retention=DEFAULT_RETENTION_SECONDS):
+    """
+    Return the process-wide checkpointer for a SQLite file, creating the file on first use.
+
+    Conversations idle for longer than retention seconds are deleted when the
+    checkpointer is created, and again at most every PRUNE_INTERVAL seconds.
+    Pass retention=None to keep every conversation.
+    """
+    with _CHECKPOINTER_LOCK:
+        checkpointer = _CHECKPOINTERS.get(path)
+        if checkpointer is None:
+            # One connection shared by every thread; SqliteSaver guards it with a lock
+            connection = sqlite3.connect(path, check_same_thread=False)
+            checkpointer = _CHECKPOINTERS[path] = ThreadedSqliteSaver(connection)
+    if retention is not None and time.time() - checkpointer.last_pruned > PRUNE_INTERVAL:
+        try:
+            checkpointer.prune(retention)
+        except sqlite3.Error as e:
+            print(f"Error pruning conversation checkpoints: {str(e)}")
+    return checkpointer
+
+def conversation_thread_id(conversation_id, patient_id):
+    """Checkpoint thread of one conversation about one patient."""
+    return f"{conversation_id}:{patient_id}"
+
+def load_history(checkpointer, thread_id, limit=20):
+    """
+    Load the recent chat history of a conversation from its latest checkpoint.
+
+    Parameters:
+    - checkpointer: The checkpointer the agent graph was compiled with
+    - thread_id: The conversation's checkpoint thread
+    - limit: Number of most recent messages to return
+
+    Returns:
+    - ([{"role": "user" | "assistant", "content": text}, ...], total number of messages)
+    """
+    checkpoint = checkpointer.get_tuple({"configurable": {"thread_id": thread_id}})
+    if checkpoint is None:
+        return [], 0
+    history = []
+    for message in checkpoint.checkpoint["channel_values"].get("messages", []):
+        if message.type == "human":
+            history.append({"role": "user", "content": message.content})
+        # Only final answers are shown: not tool calls, tool results or the agent's "list_tables" routing marker
+        elif (message.type == "ai" and not message.tool_calls and isinstance(message.content, str)
+              and message.content and message.content != "list_tables"):
+            history.append({"role": "assistant", "content": message.content})
+    return history[-limit:], len(history)
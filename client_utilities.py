@@ -0,0 +1,73 @@
+import hashlib
+import threading
+import time
+
+# Process-level client registry
+# Streamlit re-runs the whole script on every interaction; clients are created
+# once per (service, credentials, region) and reused across reruns and sessions.
+# SDKs are imported on first use so that they don't slow down cold start.
+_CLIENTS = {}
+_CLIENT_LOCK = threading.Lock()
+
+# One-off start-up costs of this process (app module imports, SDK imports), in seconds.
+# Kept here rather than in the app script, as Streamlit re-executes the script on every
+# interaction while imported modules like this one live for the whole process.
+_STARTUP_SECONDS = {}
+
+def record_startup(name, seconds):
+    """Record a start-up cost; only the first record under a name is kept."""
+    _STARTUP_SECONDS.setdefault(name, seconds)
+
+def startup_seconds():
+    """Return the recorded start-up costs, in the order they were first recorded."""
+    return dict(_STARTUP_SECONDS)
+
+def _registry_key(service, *credentials):
+    # Credentials are hashed so that raw secrets are not kept as dict keys
+    digest = hashlib.sha256("\0".join(str(value) for value in credentials).encode("utf-8")).hexdigest()
+    return service, digest
+
+def _get_or_create(key, factory):
+    client = _CLIENTS.get(key)
+    if client is not None:
+        return client
+    with _CLIENT_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            client = _CLIENTS[key] = factory()
+        return client
+
+def get_genai_client(api_key):
+    """Return the shared Gemini client for an API key."""
+    def create():
+        started = time.perf_counter()
+        from google import genai
+        record_startup("google.genai import", time.perf_counter() - started)
+        return genai.Client(api_key=api_key)
+    return _get_or_create(_registry_key("genai", api_key), create)
+
+def get_polly_client(aws_access_key_id, aws_secret_access_key, region_name):
+    """Return the shared Amazon Polly client for a set of AWS credentials and region."""
+    def create():
+        started = time.perf_counter()
+        import boto3
+        record_startup("boto3 import", time.perf_counter() - started)
+        return boto3.client('polly',
+                            aws_access_key_id=aws_access_key_id,
+                            aws_secret_access_key=aws_secret_access_key,
+                            region_name=region_name)
+    return _get_or_create(_registry_key("polly", aws_access_key_id, aws_secret_access_key, region_name), create)
+
+def get_groq_client(api_key):
+    """Return the shared Groq client for an API key."""
+    def create():
+        started = time.perf_counter()
+        from groq import Groq
+        record_startup("groq import", time.perf_counter() - started)
+        return Groq(api_key=api_key)
+    return _get_or_create(_registry_key("groq", api_key), create)
+
+def clear_clients():
+    """Forget every cached client, e.g. after rotating credentials."""
+    with _CLIENT_LOCK:
+        _CLIENTS.clear()
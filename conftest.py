@@ -0,0 +1 @@
+# Lets the tests import the top-level *_utilities modules when pytest is run from the repository root
@@ -0,0 +1,115 @@
+import json
+import logging
+from langchain_core.messages import AIMessage, HumanMessage, RemoveMessage, ToolMessage
+from sql_utilities import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+def message_tokens(message):
+    """Approximate the prompt tokens a message costs, including any tool call arguments."""
+    content = message.content if isinstance(message.content, str) else json.dumps(message.content)
+    tool_calls = getattr(message, "tool_calls", None) or []
+    return estimate_tokens(content) + sum(estimate_tokens(json.dumps(call.get("args", {}))) for call in tool_calls)
+
+def context_tokens(messages):
+    return sum(message_tokens(message) for message in messages)
+
+def summarize_tool_message(message, max_chars=200):
+    """Replace a stale tool result with a short stub that keeps its header and size."""
+    content = str(message.content)
+    if content.startswith("[pruned"):
+        return None
+    lines = content.splitlines()
+    header = lines[0][:max_chars] if lines else ""
+    note = lines[-1][:max_chars] if len(lines) > 1 and lines[-1].startswith("--") else ""
+    summary = f"[pruned earlier result of {len(content)} chars; columns: {header}]"
+    if note:
+        summary += f" {note}"
+    if len(summary) >= len(content):
+        return None
+    # Same id, so the add_messages reducer replaces the original message in the state
+    return ToolMessage(content=summary, tool_call_id=message.tool_call_id, name=message.name, id=message.id)
+
+def split_turns(messages):
+    """Group a conversation's messages into chat turns, each starting with a user message."""
+    turns = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+def has_earlier_turns(messages):
+    """True if the conversation had turns before the current question (a checkpointed follow-up)."""
+    return sum(isinstance(message, HumanMessage) for message in messages) > 1
+
+def _is_final_answer(message):
+    return (isinstance(message, AIMessage) and not message.tool_calls and isinstance(message.content, str)
+            and message.content != "list_tables")
+
+def prune_messages(messages, token_budget):
+    """
+    Shrink the message history to fit token_budget.
+
+    In order, until the history fits:
+    1. Stale tool results are stubbed, oldest first; the most recent one is
+       always kept intact because the model is about to read it.
+    2. The queries and results of earlier chat turns are removed, keeping
+       each earlier turn's question and final answer.
+    3. Earlier turns are removed altogether, oldest first.
+    The current turn is never removed, and tool calls are only removed
+    together with their results, as every call must keep its matching result.
+
+    Returns:
+    - (replacements, tokens_before, tokens_after): messages to merge into the state
+      (stubs, and RemoveMessages for the add_messages reducer)
+    """
+    tokens_before = tokens = context_tokens(messages)
+    replacements = []
+    tool_messages = [message for message in messages if isinstance(message, ToolMessage)]
+    for message in tool_messages[:-1]:
+        if tokens <= token_budget:
+            break
+        summary = summarize_tool_message(message)
+        if summary is None:
+            continue
+        tokens -= message_tokens(message) - message_tokens(summary)
+        replacements.append(summary)
+    if tokens <= token_budget:
+        return replacements, tokens_before, tokens
+
+    stubs = {replacement.id: replacement for replacement in replacements}
+    removed = set()
+    def remove(message):
+        nonlocal tokens
+        tokens -= message_tokens(stubs.get(message.id, message))
+        removed.add(message.id)
+
+    earlier_turns = split_turns(messages)[:-1]
+    for turn in earlier_turns:
+        if tokens <= token_budget:
+            break
+        # A whole turn at a time, so no tool call is separated from its result
+        for message in turn:
+            if not isinstance(message, HumanMessage) and not _is_final_answer(message):
+                remove(message)
+    for turn in earlier_turns:
+        if tokens <= token_budget:
+            break
+        for message in turn:
+            if message.id not in removed:
+                remove(message)
+    replacements = [replacement for replacement in replacements if replacement.id not in removed]
+    replacements.extend(RemoveMessage(id=message_id) for message_id in removed)
+    return replacements, tokens_before, tokens
+
+def token_usage(node, response):
+    """Record and log the tokens an LLM call in a graph node consumed."""
+    usage = getattr(response, "usage_metadata", None) or {}
+    entry = {
+        "node": node,
+        "input_tokens": usage.get("input_tokens", 0),
+        "output_tokens": usage.get("output_tokens", 0),
+    }
+    logger.info("tokens node=%s in=%d out=%d", node, entry["input_tokens"], entry["output_tokens"])
+    return [entry]
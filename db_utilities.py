@@ -0,0 +1,337 @@
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import StaticPool
+from langchain_community.utilities.sql_database import SQLDatabase
+
+# Process-wide engine registry
+# One SQLAlchemy engine (and one connection pool) per database URI, shared by
+# every DatabaseAgent in the process instead of reconnecting on each question.
+_ENGINES = {}
+_DATABASES = {}
+_SCHEMA_CACHES = {}
+_DIRECTORIES = {}
+_ENGINE_LOCK = threading.Lock()
+
+DEFAULT_POOL_SETTINGS = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_recycle": 3600,
+    "pool_pre_ping": True,
+    "pool_timeout": 30,
+}
+
+def _engine_kwargs(uri, pool_settings):
+    """
+    Build the create_engine keyword arguments for a URI.
+
+    In-memory SQLite uses a single connection shared by every thread (StaticPool),
+    as each new connection would open a separate, empty database. The
+    size/overflow settings of a queue pool do not apply to it.
+    """
+    url = make_url(uri)
+    kwargs = dict(DEFAULT_POOL_SETTINGS)
+    kwargs.update(pool_settings)
+    if url.get_backend_name() == "sqlite":
+        kwargs.pop("pool_recycle", None)
+        if url.database in (None, "", ":memory:"):
+            for key in ("pool_size", "max_overflow", "pool_timeout"):
+                kwargs.pop(key, None)
+            kwargs["poolclass"] = StaticPool
+            kwargs["connect_args"] = {"check_same_thread": False}
+    return kwargs
+
+def get_engine(uri, **pool_settings):
+    """
+    Return the shared engine for a database URI, creating it on first use.
+
+    Parameters:
+    - uri: SQLAlchemy database URI (e.g. 'mysql+pymysql://...' or 'sqlite:///patients.db')
+    - pool_settings: Overrides for DEFAULT_POOL_SETTINGS (pool_size, max_overflow,
+      pool_recycle, pool_pre_ping, pool_timeout). Only used when the engine is created.
+
+    Returns:
+    - SQLAlchemy Engine
+    """
+    engine = _ENGINES.get(uri)
+    if engine is not None:
+        return engine
+    with _ENGINE_LOCK:
+        engine = _ENGINES.get(uri)
+        if engine is None:
+            engine = create_engine(uri, **_engine_kwargs(uri, pool_settings))
+            _ENGINES[uri] = engine
+        return engine
+
+def get_sql_database(uri, **pool_settings):
+    """
+    Return the shared LangChain SQLDatabase wrapper for a database URI.
+
+    The wrapper is built on the pooled engine with lazy table reflection, so the
+    schema is only inspected once per process rather than once per question.
+    """
+    database = _DATABASES.get(uri)
+    if database is not None:
+        return database
+    engine = get_engine(uri, **pool_settings)
+    with _ENGINE_LOCK:
+        database = _DATABASES.get(uri)
+        if database is None:
+            database = SQLDatabase(engine, lazy_table_reflection=True, sample_rows_in_table_info=0)
+            _DATABASES[uri] = database
+        return database
+
+def pool_stats(uri=None):
+    """
+    Report connection pool statistics.
+
+    Parameters:
+    - uri: Database URI to report on. If None, report on every registered engine.
+
+    Returns:
+    - Dict with pool class, size, checked in/out connections and overflow
+      (or a dict of such dicts keyed by password-masked URI when uri is None)
+    """
+    if uri is None:
+        return {make_url(key).render_as_string(hide_password=True): pool_stats(key)
+                for key in list(_ENGINES)}
+    engine = _ENGINES.get(uri)
+    if engine is None:
+        return {}
+    pool = engine.pool
+    stats = {"pool": type(pool).__name__, "status": pool.status()}
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        method = getattr(pool, name, None)
+        if callable(method):
+            stats[name] = method()
+    return stats
+
+def dispose_engines():
+    """Close every pooled connection and forget all registered engines."""
+    with _ENGINE_LOCK:
+        for engine in _ENGINES.values():
+            engine.dispose()
+        _ENGINES.clear()
+        _DATABASES.clear()
+        _SCHEMA_CACHES.clear()
+        _DIRECTORIES.clear()
+
+# Schema snapshot cache
+# Queries that cheaply detect schema changes without re-reflecting every table.
+# MySQL: table count, newest CREATE_TIME (bumped by ALTER TABLE) and column count.
+# SQLite: PRAGMA schema_version is incremented on every schema change.
+SCHEMA_FINGERPRINT_QUERIES = {
+    "mysql": """
+        SELECT COUNT(*), MAX(CREATE_TIME),
+               (SELECT COUNT(*) FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE())
+        FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()
+    """,
+    "sqlite": "PRAGMA schema_version",
+}
+
+class SchemaCache:
+    """
+    Cache the table list, column definitions and table info of a database.
+
+    The snapshot is reloaded when it is older than ttl seconds, or when the
+    information_schema fingerprint changes. The fingerprint is checked at most
+    once every check_interval seconds, so most questions cost no DB round trip.
+    """
+    def __init__(self, db, ttl=3600, check_interval=60):
+        self.db = db
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.version = 0
+        self._snapshot = None
+        self._loaded_at = 0.0
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def fingerprint(self):
+        """Return a value that changes when the schema changes, or None if the dialect is unsupported."""
+        query = SCHEMA_FINGERPRINT_QUERIES.get(self.db.dialect)
+        if query is None:
+            return None
+        with self.db._engine.connect() as connection:
+            return tuple(connection.execute(text(query)).fetchone())
+
+    def _load(self):
+        # A fresh wrapper, because SQLDatabase only lists the tables that existed when it was created.
+        # No sample rows: they would put other patients' records into every prompt.
+        database = SQLDatabase(self.db._engine, lazy_table_reflection=True, sample_rows_in_table_info=0)
+        tables = sorted(database.get_usable_table_names())
+        inspector = inspect(self.db._engine)
+        columns = {table: [column["name"] for column in inspector.get_columns(table)] for table in tables}
+        return {
+            "tables": tables,
+            "columns": columns,
+            "table_info": database.get_table_info(tables),
+            "fingerprint": self.fingerprint(),
+        }
+
+    def _is_stale(self, now):
+        if self._snapshot is None or now - self._loaded_at > self.ttl:
+            return True
+        if now - self._checked_at < self.check_interval:
+            return False
+        self._checked_at = now
+        return self.fingerprint() != self._snapshot["fingerprint"]
+
+    def get(self):
+        """
+        Return the current schema snapshot, reloading it if needed.
+
+        Returns:
+        - Dict with 'tables', 'columns' (table -> column names), 'table_info'
+          (CREATE TABLE statements, without sample rows) and 'fingerprint'
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._is_stale(now):
+                self._snapshot = self._load()
+                self._loaded_at = self._checked_at = now
+                self.version += 1
+            return self._snapshot
+
+    def invalidate(self):
+        """Force the next get() to reload the schema."""
+        with self._lock:
+            self._snapshot = None
+
+def get_schema_cache(uri, **pool_settings):
+    """Return the shared SchemaCache for a database URI."""
+    cache = _SCHEMA_CACHES.get(uri)
+    if cache is not None:
+        return cache
+    database = get_sql_database(uri, **pool_settings)
+    with _ENGINE_LOCK:
+        cache = _SCHEMA_CACHES.get(uri)
+        if cache is None:
+            cache = SchemaCache(database)
+            _SCHEMA_CACHES[uri] = cache
+        return cache
+
+# Patient directory
+class PatientDirectory:
+    """
+    Paginated patient search for the sidebar selector.
+
+    Searches by id (all-digit queries) or by name prefix, ordered by (name, id)
+    and paginated with keyset cursors, so every page is an index range scan no
+    matter how large the table is. Recent lookups are cached for ttl seconds.
+    """
+    def __init__(self, uri, table="patients", id_column="patient_id", name_column="full_name",
+                 page_size=20, ttl=300, max_entries=1024):
+        self.engine = get_engine(uri)
+        self._names = (table, id_column, name_column)
+        quote = self.engine.dialect.identifier_preparer.quote
+        self.table, self.id_column, self.name_column = quote(table), quote(id_column), quote(name_column)
+        self.index_name = quote(f"ix_{table}_{name_column}_{id_column}")
+        self.page_size = page_size
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def ensure_index(self):
+        """
+        Create the (name, id) index that backs prefix search and keyset pagination, if it is missing.
+
+        Returns:
+        - True if the index exists (or was created), False if it could not be created
+        """
+        table, id_column, name_column = self._names
+        try:
+            indexes = inspect(self.engine).get_indexes(table)
+            if any([column.lower() for column in index["column_names"][:2] if column] == [name_column.lower(), id_column.lower()]
+                   for index in indexes):
+                return True
+            statement = f"CREATE INDEX {self.index_name} ON {self.table} ({self.name_column}, {self.id_column})"
+            with self.engine.begin() as connection:
+                connection.execute(text(statement))
+            return True
+        except Exception as e:
+            # e.g. the database user may not create indexes; search still works, with table scans
+            print(f"Index on {table} ({name_column}, {id_column}) not created: {str(e)}")
+            return False
+
+    def search(self, query="", cursor=None, page_size=None):
+        """
+        Find patients by id or name prefix.
+
+        Parameters:
+        - query: An exact patient id, or a name prefix ('' lists everyone)
+        - cursor: The next_cursor returned with the previous page, or None for the first page
+        - page_size: Rows per page (defaults to self.page_size)
+
+        Returns:
+        - (patients, next_cursor): a list of (id, name) tuples and the cursor of the
+          following page, or None on the last page
+        """
+        query = (query or "").strip()
+        page_size = page_size or self.page_size
+        key = (query.lower(), cursor, page_size)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > now:
+                self._cache.move_to_end(key)
+                return cached[1]
+
+        result = self._fetch(query, cursor, page_size)
+        with self._lock:
+            self._cache[key] = (now + self.ttl, result)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return result
+
+    def _fetch(self, query, cursor, page_size):
+        conditions, parameters = [], {"limit": page_size + 1}
+        if query.isdigit():
+            conditions.append(f"{self.id_column} = :patient_id")
+            parameters["patient_id"] = int(query)
+        elif query:
+            # '!' is used as the LIKE escape character because backslash is itself an escape in MySQL strings
+            escaped = query.replace("!", "!!").replace("%", "!%").replace("_", "!_")
+            conditions.append(f"{self.name_column} LIKE :prefix ESCAPE '!'")
+            parameters["prefix"] = escaped + "%"
+        if cursor is not None:
+            conditions.append(f"({self.name_column} > :cursor_name OR "
+                              f"({self.name_column} = :cursor_name AND {self.id_column} > :cursor_id))")
+            parameters["cursor_name"], parameters["cursor_id"] = cursor
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        statement = (f"SELECT {self.id_column}, {self.name_column} FROM {self.table} {where} "
+                     f"ORDER BY {self.name_column}, {self.id_column} LIMIT :limit")
+        with self.engine.connect() as connection:
+            rows = [tuple(row) for row in connection.execute(text(statement), parameters)]
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = (rows[-1][1], rows[-1][0])
+        return rows, next_cursor
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+def get_patient_directory(uri, **settings):
+    """
+    Return the shared PatientDirectory for a database URI. Settings only apply when it is first created.
+
+    The (name, id) index its searches rely on is created along with it, if it is missing.
+    """
+    directory = _DIRECTORIES.get(uri)
+    if directory is not None:
+        return directory
+    get_engine(uri)
+    with _ENGINE_LOCK:
+        directory = _DIRECTORIES.get(uri)
+        if directory is not None:
+            return directory
+        directory = _DIRECTORIES[uri] = PatientDirectory(uri, **settings)
+    # Outside the lock, as it talks to the database
+    directory.ensure_index()
+    return directory
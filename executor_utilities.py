@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class ExecutorBusy(RuntimeError):
+    """Raised when the executor queue is full and the caller should retry later."""
+
+def _key_label(key):
+    # Limits are tracked per API key, but keys are never exposed in stats
+    return hashlib.sha256(str(key).encode("utf-8")).hexdigest()[:8]
+
+class QuestionExecutor:
+    """
+    Shared asyncio engine that runs agent questions for every session.
+
+    Work runs on one background event loop. At most max_concurrency questions
+    run at once overall, and at most per_key_concurrency per API key. Up to
+    max_pending questions may be queued or running; beyond that, submit()
+    waits up to its timeout and then raises ExecutorBusy (backpressure).
+    Blocking calls made by the agent (DB queries, sync tools) run on a bounded
+    thread pool that serves as the loop's default executor.
+    """
+    def __init__(self, max_concurrency=16, per_key_concurrency=4, max_pending=64, thread_pool_size=32):
+        self.max_concurrency = max_concurrency
+        self.per_key_concurrency = per_key_concurrency
+        self.max_pending = max_pending
+        self.thread_pool_size = thread_pool_size
+        self._pending = 0
+        self._running = 0
+        self._condition = threading.Condition()
+        self._loop = None
+        self._global_limit = None
+        self._key_limits = {}
+
+    def _ensure_loop(self):
+        with self._condition:
+            if self._loop is not None:
+                return self._loop
+            loop = asyncio.new_event_loop()
+            loop.set_default_executor(ThreadPoolExecutor(self.thread_pool_size, thread_name_prefix="agent"))
+            threading.Thread(target=loop.run_forever, name="question-executor", daemon=True).start()
+            self._loop = loop
+            return loop
+
+    def _acquire_slot(self, timeout):
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._pending < self.max_pending, timeout=timeout):
+                raise ExecutorBusy(f"{self._pending} questions are already queued; try again shortly.")
+            self._pending += 1
+
+    def _release_slot(self, *_):
+        with self._condition:
+            self._pending -= 1
+            self._condition.notify()
+
+    def _limits(self, key):
+        # Semaphores are created lazily on the executor's own loop
+        if self._global_limit is None:
+            self._global_limit = asyncio.Semaphore(self.max_concurrency)
+        label = _key_label(key)
+        if label not in self._key_limits:
+            self._key_limits[label] = asyncio.Semaphore(self.per_key_concurrency)
+        return self._global_limit, self._key_limits[label]
+
+    async def _limited(self, key, coroutine_factory):
+        global_limit, key_limit = self._limits(key)
+        async with key_limit, global_limit:
+            self._running += 1
+            try:
+                return await coroutine_factory()
+            finally:
+                self._running -= 1
+
+    def submit(self, key, coroutine_factory, timeout=0):
+        """
+        Schedule a coroutine under the global and per-key limits.
+
+        Parameters:
+        - key: The API key the work is billed to
+        - coroutine_factory: Zero-argument callable returning the coroutine to run
+        - timeout: Seconds to wait for queue space before raising ExecutorBusy
+
+        Returns:
+        - concurrent.futures.Future with the coroutine's result
+        """
+        loop = self._ensure_loop()
+        self._acquire_slot(timeout)
+        future = asyncio.run_coroutine_threadsafe(self._limited(key, coroutine_factory), loop)
+        future.add_done_callback(self._release_slot)
+        return future
+
+    async def asubmit(self, key, coroutine_factory, timeout=0):
+        """Submit from async code running on another event loop, and await the result."""
+        await asyncio.to_thread(self._acquire_slot, timeout)
+        future = asyncio.run_coroutine_threadsafe(self._limited(key, coroutine_factory), self._ensure_loop())
+        future.add_done_callback(self._release_slot)
+        return await asyncio.wrap_future(future)
+
+    def stream(self, key, async_iterator_factory, timeout=0):
+        """
+        Run an async generator under the executor's limits and iterate it from synchronous code.
+
+        Parameters:
+        - key: The API key the work is billed to
+        - async_iterator_factory: Zero-argument callable returning an async iterator (e.g. agent.astream(...))
+        - timeout: Seconds to wait for queue space before raising ExecutorBusy
+
+        Yields the items of the async iterator as they are produced. Closing the
+        generator early cancels the async iterator.
+        """
+        items = queue.Queue()
+        finished = object()
+
+        async def pump():
+            try:
+                async for item in async_iterator_factory():
+                    items.put(item)
+            finally:
+                items.put(finished)
+
+        future = self.submit(key, pump, timeout)
+        try:
+            while True:
+                item = items.get()
+                if item is finished:
+                    break
+                yield item
+            # Re-raise any exception from the async iterator
+            future.result()
+        finally:
+            # The caller stopped early (closed the generator or raised): stop the work
+            # instead of letting it run to completion and hold its slots
+            if not future.done():
+                future.cancel()
+
+    def stats(self):
+        return {
+            "pending": self._pending,
+            "running": self._running,
+            "max_pending": self.max_pending,
+            "max_concurrency": self.max_concurrency,
+            "per_key_concurrency": self.per_key_concurrency,
+            "keys": len(self._key_limits),
+        }
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+def get_question_executor(**settings):
+    """Return the process-wide QuestionExecutor. Settings only apply when it is first created."""
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = QuestionExecutor(**settings)
+        return _EXECUTOR
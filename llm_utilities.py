@@ -1,32 +1,215 @@
-from google.genai import types
-from google import genai
+import asyncio
+import contextvars
+import functools
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+import uuid
+import wave
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from metrics_utilities import get_tracer
 
 # Gemini Client
 # Transcribe audio to text
 # Added a mime_type argument, as the original code saved to .wav but specified audio/mp3..
-def transcribe_audio(gemini_client, audio_path, mime_type='audio/wav',show_debug=False):
-    with open(audio_path, "rb") as audio_file:
-        audio_bytes = audio_file.read()
+def transcribe_audio(gemini_client, audio, mime_type='audio/wav',show_debug=False, reencode=None):
+    """
+    Transcribe speech with Gemini.
+
+    Parameters:
+    - audio: Audio bytes/bytearray/memoryview, or the path of an audio file (legacy callers)
+    - mime_type: MIME type of the audio
+    - reencode: Optionally shrink WAV audio before upload: 'wav16k' (16 kHz mono PCM),
+      'flac' or 'opus' (both 16 kHz mono, need pydub and ffmpeg)
+
+    Returns:
+    - Transcript text
+    """
+    if isinstance(audio, (bytes, bytearray, memoryview)):
+        audio_bytes = bytes(audio)
+    else:
+        with open(audio, "rb") as audio_file:
+            audio_bytes = audio_file.read()
+    if reencode and mime_type in ('audio/wav', 'audio/x-wav'):
+        original_size = len(audio_bytes)
+        audio_bytes, mime_type = reencode_audio(audio_bytes, reencode)
+        if show_debug:
+            print(f"Re-encoded audio to {mime_type}: {original_size} -> {len(audio_bytes)} bytes")
     
+    # Imported on first use to keep app start-up fast
+    from google.genai import types
+
     prompt = 'Generate a transcript of the speech.'
-    response = gemini_client.models.generate_content(
-                    model='gemini-2.0-flash',
-                    contents=[
-                        prompt,
-                        types.Part.from_bytes(
-                        data=audio_bytes,
-                        mime_type=mime_type,
+    with get_tracer().span("transcribe", "gemini", request_bytes=len(audio_bytes), mime_type=mime_type) as attributes:
+        response = gemini_client.models.generate_content(
+                        model='gemini-2.0-flash',
+                        contents=[
+                            prompt,
+                            types.Part.from_bytes(
+                            data=audio_bytes,
+                            mime_type=mime_type,
+                            )
+                        ],
+                        config=types.GenerateContentConfig(
+                            max_output_tokens=1000,
+                            temperature=0,
+                            system_instruction="You are a helpful AI Assitant. Your job is transform the content of audio into text.",
                         )
-                    ],
-                    config=types.GenerateContentConfig(
-                        max_output_tokens=1000,
-                        temperature=0,
-                        system_instruction="You are a helpful AI Assitant. Your job is transform the content of audio into text.",
-                    )
-                    
-                    )
+                        
+                        )
+        usage = getattr(response, "usage_metadata", None)
+        attributes["input_tokens"] = getattr(usage, "prompt_token_count", None) or 0
+        attributes["output_tokens"] = getattr(usage, "candidates_token_count", None) or 0
+        attributes["response_bytes"] = len((response.text or "").encode("utf-8"))
     return response.text
 
+# Audio re-encoding before upload
+SPEECH_SAMPLE_RATE = 16000
+_SAMPLE_DTYPES = {1: "uint8", 2: "<i2", 4: "<i4"}
+
+def downsample_wav(wav_bytes, sample_rate=SPEECH_SAMPLE_RATE):
+    """
+    Convert WAV audio to 16-bit mono PCM at sample_rate (16 kHz is plenty for speech).
+
+    Returns the original bytes unchanged if the WAV can't be parsed or is already small enough.
+    """
+    import numpy as np
+
+    try:
+        with wave.open(io.BytesIO(wav_bytes), "rb") as source:
+            channels, width, rate = source.getnchannels(), source.getsampwidth(), source.getframerate()
+            frames = source.readframes(source.getnframes())
+    except (wave.Error, EOFError):
+        return wav_bytes
+    if width not in _SAMPLE_DTYPES or (channels == 1 and width == 2 and rate <= sample_rate):
+        return wav_bytes
+
+    samples = np.frombuffer(frames, dtype=_SAMPLE_DTYPES[width]).astype(np.float64)
+    if width == 1:
+        samples = (samples - 128) * 256
+    elif width == 4:
+        samples = samples / 65536
+    samples = samples.reshape(-1, channels).mean(axis=1)
+    if rate > sample_rate:
+        duration = len(samples) / rate
+        target = np.arange(int(duration * sample_rate)) / sample_rate
+        samples = np.interp(target, np.arange(len(samples)) / rate, samples)
+        rate = sample_rate
+
+    output = io.BytesIO()
+    with wave.open(output, "wb") as target_wav:
+        target_wav.setnchannels(1)
+        target_wav.setsampwidth(2)
+        target_wav.setframerate(rate)
+        target_wav.writeframes(np.clip(samples, -32768, 32767).astype("<i2").tobytes())
+    return output.getvalue()
+
+def reencode_audio(wav_bytes, codec="wav16k"):
+    """
+    Re-encode WAV audio to cut upload size.
+
+    Parameters:
+    - wav_bytes: WAV audio
+    - codec: 'wav16k', 'flac' or 'opus'
+
+    Returns:
+    - (audio_bytes, mime_type). FLAC/Opus fall back to 16 kHz WAV if pydub/ffmpeg are unavailable.
+    """
+    wav_bytes = downsample_wav(wav_bytes)
+    if codec == "wav16k":
+        return wav_bytes, "audio/wav"
+    formats = {"flac": ("flac", {}, "audio/flac"), "opus": ("ogg", {"codec": "libopus"}, "audio/ogg")}
+    if codec not in formats:
+        raise ValueError(f"Unsupported codec: {codec}")
+    export_format, export_args, mime_type = formats[codec]
+    try:
+        from pydub import AudioSegment
+        output = io.BytesIO()
+        AudioSegment.from_wav(io.BytesIO(wav_bytes)).export(output, format=export_format, **export_args)
+        return output.getvalue(), mime_type
+    except Exception as e:
+        print(f"Error re-encoding audio to {codec}, sending WAV instead: {str(e)}")
+        return wav_bytes, "audio/wav"
+
+class AudioSpool:
+    """
+    Size- and age-bounded directory for callers that still need audio on disk.
+
+    Files older than max_age seconds are removed, and the oldest files are
+    evicted whenever the spool grows beyond max_bytes. Only files created by the
+    spool (prefixed with 'spool_') are ever deleted, and never one that is still
+    being written or is in use by spooled().
+    """
+    def __init__(self, directory="audio", max_bytes=50 * 1024 * 1024, max_age=3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # Files being written or handed out by spooled(); eviction never removes them
+        self._in_use = set()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _create(self, audio_data, suffix):
+        path = os.path.join(self.directory, f"spool_{int(time.time())}_{uuid.uuid4().hex}{suffix}")
+        with self._lock:
+            self._in_use.add(path)
+        with open(path, "wb") as file:
+            file.write(bytes(audio_data))
+        self.evict()
+        return path
+
+    def write(self, audio_data, suffix=".wav"):
+        """Write audio data to a new spool file and return its path (the eviction this triggers spares the new file)."""
+        path = self._create(audio_data, suffix)
+        with self._lock:
+            self._in_use.discard(path)
+        return path
+
+    @contextmanager
+    def spooled(self, audio_data, suffix=".wav"):
+        """Context manager that yields a spool file path and removes the file afterwards."""
+        path = self._create(audio_data, suffix)
+        try:
+            yield path
+        finally:
+            with self._lock:
+                self._in_use.discard(path)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def evict(self):
+        """Delete expired files, then the oldest files until the spool fits in max_bytes."""
+        with self._lock:
+            now = time.time()
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.startswith("spool_"):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            for mtime, size, path in entries:
+                if now - mtime <= self.max_age and total <= self.max_bytes:
+                    break
+                if path in self._in_use:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
 # AI Assistant
 def respond_to_text(gemini_client, user_query):
     if not user_query:
@@ -58,7 +241,7 @@ async def output_audio(groq_client, text, output_audio_path):
     response.write_to_file(output_audio_path)
     return response
 
-def synthesize_speech(polly_client,text, voice_id="Ruth", engine="neural", output_format="mp3", text_type="text"):
+def synthesize_speech(polly_client,text, voice_id="Ruth", engine="neural", output_format="mp3", text_type="text", cache=None):
     """
     Synthesize speech using Amazon Polly and return the audio stream.
     
@@ -68,22 +251,197 @@ def synthesize_speech(polly_client,text, voice_id="Ruth", engine="neural", outpu
     - engine: The engine to use ('standard', 'neural', or 'long-form')
     - output_format: The output format ('mp3', 'ogg_vorbis', or 'pcm')
     - text_type: The type of input text ('text' or 'ssml')
+    - cache: Optional SpeechCache; repeated phrases are served from it without calling Polly
     
     Returns:
     - Audio stream
     """
-    try:
-        response = polly_client.synthesize_speech(
-            Text=text,
-            VoiceId=voice_id,
-            Engine=engine,
-            OutputFormat=output_format,
-            TextType=text_type
-        )
-        return response['AudioStream'].read()
-    except Exception as e:
-        print(f"Error synthesizing speech: {str(e)}")
-        return None
+    tracer = get_tracer()
+    if cache is not None:
+        key = speech_cache_key(text, voice_id, engine, output_format, text_type)
+        with tracer.span("synthesize", "cache", request_bytes=len(text.encode("utf-8"))) as attributes:
+            audio_data = cache.get(key)
+            attributes["response_bytes"] = len(audio_data or b"")
+            attributes["hit"] = audio_data is not None
+        if audio_data is not None:
+            return audio_data
+    with tracer.span("synthesize", "polly", request_bytes=len(text.encode("utf-8"))) as attributes:
+        try:
+            response = polly_client.synthesize_speech(
+                Text=text,
+                VoiceId=voice_id,
+                Engine=engine,
+                OutputFormat=output_format,
+                TextType=text_type
+            )
+            audio_data = response['AudioStream'].read()
+            attributes["response_bytes"] = len(audio_data)
+        except Exception as e:
+            print(f"Error synthesizing speech: {str(e)}")
+            attributes["error"] = f"{type(e).__name__}: {e}"
+            return None
+    if cache is not None and audio_data:
+        cache.put(key, audio_data)
+    return audio_data
+
+async def asynthesize_speech(polly_client, text, **kwargs):
+    """Async version of synthesize_speech(). The blocking Polly call runs on the event loop's default executor."""
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(synthesize_speech, polly_client, text, **kwargs))
+
+# Synthesized audio cache
+def speech_cache_key(text, voice_id, engine, output_format, text_type):
+    """Content address of a synthesis request."""
+    payload = json.dumps([text, voice_id, engine, output_format, text_type], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class SpeechCache:
+    """
+    Two-tier, content-addressed cache of synthesized audio.
+
+    The memory tier and the on-disk tier are each capped in bytes and evict the
+    least recently used entries. Disk hits are promoted to memory. The disk
+    tier's size and recency are tracked in memory, from a single scan of the
+    directory when the cache is created; files are read and written outside
+    the lock, so a slow disk never blocks lookups served from memory.
+    """
+    def __init__(self, directory="audio/cache", max_memory_bytes=16 * 1024 * 1024, max_disk_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()   # key -> file size, least recently used first
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._scan_disk()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.audio")
+
+    def _scan_disk(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".audio"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, name[:-len(".audio")], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        self._remove_files(self._evict_disk())
+
+    def get(self, key):
+        """Return cached audio bytes for a key, or None."""
+        with self._lock:
+            audio_data = self._memory.get(key)
+            if audio_data is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return audio_data
+            on_disk = key in self._disk
+        if on_disk:
+            try:
+                with open(self._path(key), "rb") as file:
+                    audio_data = file.read()
+            except FileNotFoundError:
+                audio_data = None
+        with self._lock:
+            if audio_data is None:
+                if on_disk:
+                    # Removed behind our back
+                    self._forget_disk(key)
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, audio_data)
+            if key in self._disk:
+                self._disk.move_to_end(key)
+            return audio_data
+
+    def put(self, key, audio_data):
+        """Store audio bytes in both tiers."""
+        with self._lock:
+            self._remember(key, audio_data)
+        if not self.directory or len(audio_data) > self.max_disk_bytes:
+            return
+        # Write then rename, so concurrent readers never see a partial file
+        temporary_path = f"{self._path(key)}.{uuid.uuid4().hex}.tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(audio_data)
+        os.replace(temporary_path, self._path(key))
+        with self._lock:
+            self._forget_disk(key)
+            self._disk[key] = len(audio_data)
+            self._disk_bytes += len(audio_data)
+            evicted = self._evict_disk()
+        self._remove_files(evicted)
+
+    def _remember(self, key, audio_data):
+        if len(audio_data) > self.max_memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous)
+        self._memory[key] = audio_data
+        self._memory_bytes += len(audio_data)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _forget_disk(self, key):
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_bytes -= size
+
+    def _evict_disk(self):
+        """Drop the least recently used disk entries over the cap from the index; returns their keys."""
+        evicted = []
+        while self._disk_bytes > self.max_disk_bytes:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            evicted.append(key)
+        return evicted
+
+    def _remove_files(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """Return hit/miss counters, hit rate and memory usage."""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "disk_entries": len(self._disk),
+            "disk_bytes": self._disk_bytes,
+        }
+
+_SPEECH_CACHE = None
+_SPEECH_CACHE_LOCK = threading.Lock()
+
+def get_speech_cache():
+    """Return the process-wide SpeechCache, creating it on first use."""
+    global _SPEECH_CACHE
+    with _SPEECH_CACHE_LOCK:
+        if _SPEECH_CACHE is None:
+            _SPEECH_CACHE = SpeechCache()
+        return _SPEECH_CACHE
 
 def save_audio_file(audio_data, file_path):
     """
@@ -102,4 +460,152 @@ def save_audio_file(audio_data, file_path):
                 file.write(audio_data)
             print(f"Audio saved to {file_path}")
         except Exception as e:
-            print(f"Error saving audio file: {str(e)}")
\ No newline at end of file
+            print(f"Error saving audio file: {str(e)}")
+# Sentence-chunked speech pipeline
+# Polly rejects requests above 3000 billed characters, so long sentences are split further.
+MAX_SPEECH_CHUNK_CHARS = 1500
+# Shorter fragments are merged into the next sentence: every chunk is a separate Polly call,
+# and very short ones make the answer sound choppy
+MIN_SPEECH_CHUNK_CHARS = 40
+# Sentence ends, except after common abbreviations ("Dr. Smith")
+SPEECH_ABBREVIATIONS = ("Dr", "Mr", "Mrs", "Ms", "Prof", "St", "vs", "approx", "e.g", "i.e", "etc", "No")
+SENTENCE_BOUNDARY = re.compile("".join(rf"(?<!\b{re.escape(abbreviation)}\.)" for abbreviation in SPEECH_ABBREVIATIONS)
+                               + r"(?<=[.!?;])\s+|\n+")
+
+_SPEECH_EXECUTOR = None
+_SPEECH_EXECUTOR_LOCK = threading.Lock()
+
+def get_speech_executor(max_workers=4):
+    """Return the process-wide worker pool used for speech synthesis, bounding concurrent Polly calls."""
+    global _SPEECH_EXECUTOR
+    with _SPEECH_EXECUTOR_LOCK:
+        if _SPEECH_EXECUTOR is None:
+            _SPEECH_EXECUTOR = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="speech")
+        return _SPEECH_EXECUTOR
+
+def split_sentences(text, max_chars=MAX_SPEECH_CHUNK_CHARS, min_chars=MIN_SPEECH_CHUNK_CHARS):
+    """
+    Split text into sentences for chunked synthesis.
+
+    Parameters:
+    - text: The text to split
+    - max_chars: Sentences longer than this are split again on whitespace
+    - min_chars: Sentences shorter than this are merged into the next one (or the previous one, at the end)
+
+    Returns:
+    - List of non-empty sentences
+    """
+    sentences = []
+    pending = ""
+    for sentence in SENTENCE_BOUNDARY.split(text or ""):
+        sentence = f"{pending} {sentence.strip()}".strip()
+        if len(sentence) < min_chars:
+            pending = sentence
+            continue
+        pending = ""
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            sentences.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if sentence:
+            sentences.append(sentence)
+    if pending:
+        if sentences and len(sentences[-1]) + len(pending) < max_chars:
+            sentences[-1] = f"{sentences[-1]} {pending}"
+        else:
+            sentences.append(pending)
+    return sentences
+
+class SpeechPipeline:
+    """
+    Synthesize an answer sentence by sentence while it is still being generated.
+
+    Text is fed in as it arrives; every completed sentence is submitted to a
+    bounded worker pool straight away, so synthesis overlaps with generation.
+    Audio chunks are returned in order from memory; nothing is written to disk.
+
+    Example:
+        pipeline = SpeechPipeline(polly_client)
+        for token in tokens:
+            pipeline.feed(token)
+        pipeline.close()
+        audio = pipeline.audio()
+    """
+    def __init__(self, polly_client, voice_id="Ruth", engine="neural", output_format="mp3", text_type="text",
+                 executor=None, cache=None):
+        self.polly_client = polly_client
+        self.voice_id = voice_id
+        self.engine = engine
+        self.output_format = output_format
+        self.text_type = text_type
+        self.executor = executor or get_speech_executor()
+        self.cache = cache
+        self._buffer = ""
+        # Complete sentences still too short to be worth a Polly call of their own
+        self._pending = ""
+        self._futures = []
+
+    def _submit(self, sentence):
+        # Run in a copy of the caller's context, so synthesis spans are recorded under the caller's trace
+        self._futures.append(self.executor.submit(
+            contextvars.copy_context().run, synthesize_speech, self.polly_client, sentence,
+            voice_id=self.voice_id, engine=self.engine,
+            output_format=self.output_format, text_type=self.text_type, cache=self.cache))
+
+    def feed(self, text):
+        """Add generated text and submit every sentence it completes."""
+        self._buffer += text
+        # SSML can't be cut at arbitrary sentence boundaries, so it is sent in one piece on close()
+        if self.text_type == "ssml":
+            return
+        sentences = SENTENCE_BOUNDARY.split(self._buffer)
+        # The last piece may still be an unfinished sentence
+        self._buffer = sentences.pop()
+        for sentence in sentences:
+            self._pending = f"{self._pending} {sentence.strip()}".strip()
+            if len(self._pending) >= MIN_SPEECH_CHUNK_CHARS:
+                for chunk in split_sentences(self._pending):
+                    self._submit(chunk)
+                self._pending = ""
+
+    def close(self):
+        """Submit whatever text remains in the buffer."""
+        remainder, self._buffer = self._buffer, ""
+        if self.text_type == "ssml":
+            if remainder.strip():
+                self._submit(remainder)
+            return
+        remainder, self._pending = f"{self._pending} {remainder.strip()}".strip(), ""
+        for chunk in split_sentences(remainder):
+            self._submit(chunk)
+
+    def reset(self):
+        """Discard buffered text and cancel synthesis that has not started yet."""
+        for future in self._futures:
+            future.cancel()
+        self._futures = []
+        self._buffer = ""
+        self._pending = ""
+
+    def chunks(self):
+        """Yield the synthesized audio of each sentence, in order, as soon as it is ready."""
+        for future in self._futures:
+            audio_data = future.result()
+            if audio_data:
+                yield audio_data
+
+    def audio(self):
+        """
+        Return the whole answer as one in-memory audio buffer.
+
+        MP3 and PCM chunks can be concatenated directly into a single playable stream.
+        """
+        return io.BytesIO(b"".join(self.chunks()))
+
+def synthesize_speech_chunks(polly_client, text, **kwargs):
+    """Synthesize a complete text sentence by sentence and yield the audio chunks in order."""
+    pipeline = SpeechPipeline(polly_client, **kwargs)
+    pipeline.feed(text)
+    pipeline.close()
+    yield from pipeline.chunks()
@@ -0,0 +1,207 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets exported to Prometheus
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Numeric span attributes that are also summed into counters
+COUNTED_ATTRIBUTES = ("input_tokens", "output_tokens", "request_bytes", "response_bytes")
+
+# Id of the chat turn the current code is working on; copied into threads and tasks with the context
+_TRACE_ID = contextvars.ContextVar("trace_id", default=None)
+
+def current_trace_id():
+    return _TRACE_ID.get()
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a list of numbers (0.0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))]
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Tracer:
+    """
+    In-process tracing and metrics for the agent and the voice pipeline.
+
+    Every instrumented step (graph node, LLM call, DB query, transcription,
+    synthesis) is recorded as a span with its duration, the chat turn it
+    belongs to and attributes such as tokens and payload sizes. The most
+    recent spans are kept in memory, and per-step aggregates are kept for
+    the lifetime of the process.
+
+    Example:
+        tracer = get_tracer()
+        with tracer.trace() as trace_id:
+            with tracer.span("db", "query") as attributes:
+                result = run_query()
+                attributes["response_bytes"] = len(result)
+        tracer.spans(trace_id)
+    """
+    def __init__(self, max_spans=5000, jsonl_path=None):
+        self.jsonl_path = jsonl_path
+        self._spans = deque(maxlen=max_spans)
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    @contextmanager
+    def trace(self, trace_id=None):
+        """Attribute every span recorded in this block (and in threads/tasks started from it) to one chat turn."""
+        trace_id = trace_id or uuid.uuid4().hex
+        token = _TRACE_ID.set(trace_id)
+        try:
+            yield trace_id
+        finally:
+            try:
+                _TRACE_ID.reset(token)
+            except ValueError:
+                # A generator closed from another context; its context is discarded anyway
+                pass
+
+    @contextmanager
+    def span(self, kind, name, **attributes):
+        """
+        Time a block of code.
+
+        Parameters:
+        - kind: The kind of step ('node', 'llm', 'db', 'transcribe', 'synthesize')
+        - name: The step's name, e.g. the graph node
+        - attributes: Initial attributes; the block can add more to the yielded dict.
+          Setting attributes["error"] marks the span as failed without raising.
+
+        Yields the attributes dict.
+        """
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes.setdefault("error", f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            self.record(kind, name, time.perf_counter() - start, started=started, **attributes)
+
+    def record(self, kind, name, seconds, started=None, **attributes):
+        """Record a finished span, e.g. from a callback that measured the time itself."""
+        span = {
+            "trace_id": current_trace_id(),
+            "kind": kind,
+            "name": name,
+            "started": started if started is not None else time.time() - seconds,
+            "seconds": seconds,
+            **attributes,
+        }
+        with self._lock:
+            self._spans.append(span)
+            metric = self._metrics.get((kind, name))
+            if metric is None:
+                metric = self._metrics[(kind, name)] = {
+                    "count": 0, "errors": 0, "seconds": 0.0, "buckets": [0] * len(LATENCY_BUCKETS),
+                    **{attribute: 0 for attribute in COUNTED_ATTRIBUTES},
+                }
+            metric["count"] += 1
+            metric["seconds"] += seconds
+            if span.get("error"):
+                metric["errors"] += 1
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    metric["buckets"][index] += 1
+            for attribute in COUNTED_ATTRIBUTES:
+                metric[attribute] += span.get(attribute) or 0
+        if self.jsonl_path:
+            # Outside the tracer lock, so that recording spans never waits on the disk;
+            # the write lock only keeps lines from different threads whole
+            line = json.dumps(span, default=str) + "\n"
+            with self._write_lock:
+                try:
+                    with open(self.jsonl_path, "a", encoding="utf-8") as trace_file:
+                        trace_file.write(line)
+                except OSError as e:
+                    print(f"Error writing trace file: {str(e)}")
+        return span
+
+    def spans(self, trace_id=None):
+        """Return the recent spans, optionally only those of one chat turn, oldest first."""
+        with self._lock:
+            return [dict(span) for span in self._spans if trace_id is None or span["trace_id"] == trace_id]
+
+    def summary(self):
+        """Return per-step aggregates (count, errors, total and mean seconds, tokens and bytes), slowest first."""
+        with self._lock:
+            rows = [{"kind": kind, "name": name, "count": metric["count"], "errors": metric["errors"],
+                     "seconds": metric["seconds"], "mean_seconds": metric["seconds"] / metric["count"],
+                     **{attribute: metric[attribute] for attribute in COUNTED_ATTRIBUTES}}
+                    for (kind, name), metric in self._metrics.items()]
+        return sorted(rows, key=lambda row: row["seconds"], reverse=True)
+
+    def export_jsonl(self, trace_id=None):
+        """Return the recent spans as JSON lines."""
+        return "".join(json.dumps(span, default=str) + "\n" for span in self.spans(trace_id))
+
+    def prometheus_text(self):
+        """Return the aggregates in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = {key: {**metric, "buckets": list(metric["buckets"])} for key, metric in self._metrics.items()}
+        lines = [
+            "# HELP agent_step_seconds Time spent in each instrumented step.",
+            "# TYPE agent_step_seconds histogram",
+        ]
+        for (kind, name), metric in sorted(metrics.items()):
+            labels = f'kind="{_label(kind)}",name="{_label(name)}"'
+            for bound, count in zip(LATENCY_BUCKETS, metric["buckets"]):
+                lines.append(f'agent_step_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'agent_step_seconds_bucket{{{labels},le="+Inf"}} {metric["count"]}')
+            lines.append(f"agent_step_seconds_sum{{{labels}}} {metric['seconds']:.6f}")
+            lines.append(f"agent_step_seconds_count{{{labels}}} {metric['count']}")
+        counters = [
+            ("agent_step_errors_total", "Instrumented steps that failed.", lambda metric: [("", metric["errors"])]),
+            ("agent_tokens_total", "LLM tokens consumed, by direction.",
+             lambda metric: [(',direction="input"', metric["input_tokens"]), (',direction="output"', metric["output_tokens"])]),
+            ("agent_payload_bytes_total", "Bytes sent to and received from external services, by direction.",
+             lambda metric: [(',direction="request"', metric["request_bytes"]), (',direction="response"', metric["response_bytes"])]),
+        ]
+        for metric_name, description, values in counters:
+            lines.append(f"# HELP {metric_name} {description}")
+            lines.append(f"# TYPE {metric_name} counter")
+            for (kind, name), metric in sorted(metrics.items()):
+                for extra_labels, value in values(metric):
+                    lines.append(f'{metric_name}{{kind="{_label(kind)}",name="{_label(name)}"{extra_labels}}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """
+        Write the Prometheus text to a file, e.g. for node_exporter's textfile collector.
+        The file is replaced atomically so that scrapes never read a partial file.
+        """
+        temporary_path = f"{path}.tmp"
+        try:
+            with open(temporary_path, "w", encoding="utf-8") as metrics_file:
+                metrics_file.write(self.prometheus_text())
+            os.replace(temporary_path, path)
+        except OSError as e:
+            print(f"Error writing metrics file: {str(e)}")
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
+            self._metrics.clear()
+
+_TRACER = None
+_TRACER_LOCK = threading.Lock()
+
+def get_tracer(**settings):
+    """Return the process-wide Tracer. Settings only apply when it is first created."""
+    global _TRACER
+    with _TRACER_LOCK:
+        if _TRACER is None:
+            _TRACER = Tracer(**settings)
+        return _TRACER
@@ -0,0 +1,86 @@
+import logging
+import re
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+PATIENT_DATA = "patient_data"
+GENERAL = "general"
+
+# Lexicon of the patient-data vocabulary, with weights.
+# Strong terms are enough on their own to route a question to the SQL agent.
+PATIENT_DATA_TERMS = {
+    "treatment": 2.0, "treat": 1.0, "therapy": 2.0, "medication": 2.0, "medicine": 1.0,
+    "drug": 1.0, "prescription": 2.0, "prescribed": 2.0, "dose": 1.0, "dosage": 2.0,
+    "pathology": 2.0, "diagnosis": 2.0, "diagnosed": 2.0, "condition": 1.0, "disease": 1.0,
+    "tumor": 2.0, "tumour": 2.0, "cancer": 1.0, "biopsy": 2.0, "lab": 1.0, "test result": 2.0,
+    "allergy": 2.0, "allergies": 2.0, "visit": 1.0, "appointment": 2.0, "admission": 2.0,
+    "admitted": 2.0, "discharge": 2.0, "surgery": 2.0, "procedure": 1.0, "record": 1.0,
+    "phone": 2.0, "phone number": 2.0, "address": 2.0, "email": 2.0, "contact": 2.0,
+    "date of birth": 2.0, "birthday": 2.0, "age": 1.0, "gender": 1.0, "insurance": 2.0,
+    "doctor": 1.0, "physician": 1.0, "history": 1.0,
+    "patient": 1.0, "his": 0.5, "her": 0.5, "their": 0.5, "this person": 1.0,
+}
+
+# Small talk and general questions that never need the database.
+GENERAL_TERMS = {
+    "hello": 2.0, "hi": 2.0, "hey": 2.0, "good morning": 2.0, "good afternoon": 2.0,
+    "thanks": 2.0, "thank you": 2.0, "bye": 2.0, "goodbye": 2.0, "who are you": 2.0,
+    "what can you do": 2.0, "help": 1.0, "joke": 2.0, "weather": 2.0,
+    "what is": 0.5, "define": 1.0, "explain": 1.0, "in general": 1.0,
+}
+
+class RouteDecision(NamedTuple):
+    label: str           # PATIENT_DATA, GENERAL, or None when the router is not confident
+    confidence: float    # 0.0 - 1.0
+    tier: str            # which router tier made the decision ("local" or "llm")
+
+def _normalize(query):
+    return " " + " ".join(re.findall(r"[a-z0-9']+", query.lower())) + " "
+
+def _score(text, lexicon):
+    score = 0.0
+    for term, weight in lexicon.items():
+        # Allow a simple plural on the last word of the term
+        if f" {term} " in text or f" {term}s " in text:
+            score += weight
+    return score
+
+class KeywordRouter:
+    """
+    Local, CPU-only router that scores a query against the patient-data and
+    general lexicons. It only returns a label when it is confident; otherwise
+    the caller should fall back to the LLM.
+    """
+    def __init__(self, patient_terms=None, general_terms=None, threshold=0.7):
+        self.patient_terms = patient_terms or PATIENT_DATA_TERMS
+        self.general_terms = general_terms or GENERAL_TERMS
+        self.threshold = threshold
+
+    def classify(self, query):
+        """
+        Classify a query.
+
+        Parameters:
+        - query: The user's question
+
+        Returns:
+        - RouteDecision; label is None when confidence is below the threshold
+        """
+        text = _normalize(query or "")
+        patient_score = _score(text, self.patient_terms)
+        general_score = _score(text, self.general_terms)
+        if patient_score == general_score:
+            return RouteDecision(None, 0.0, "local")
+        label = PATIENT_DATA if patient_score > general_score else GENERAL
+        # Confidence grows with the winning score and shrinks with the competing one
+        winner, loser = max(patient_score, general_score), min(patient_score, general_score)
+        confidence = (1 - 0.5 ** winner) * (winner - loser) / winner
+        if confidence < self.threshold:
+            return RouteDecision(None, confidence, "local")
+        return RouteDecision(label, confidence, "local")
+
+def log_route_decision(query, decision):
+    """Log a routing decision so the router thresholds can be tuned. The query text itself is not logged."""
+    logger.info("route label=%s confidence=%.3f tier=%s query_chars=%d",
+                decision.label, decision.confidence, decision.tier, len(query or ""))
@@ -0,0 +1,194 @@
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+from db_utilities import get_engine, get_schema_cache
+from metrics_utilities import get_tracer
+from sql_utilities import is_complete_result, run_shaped_query
+
+# Queries that make up a patient's snapshot, with the question terms each one can answer.
+# :patient_id is bound as a parameter. Adjust them to the tables of your patient database.
+# Only the columns the terms refer to are selected, newest rows first. The LIMITs are above
+# take_snapshot()'s max_rows, so that a longer list is reported as cut and the section skipped.
+SNAPSHOT_QUERIES = {
+    "contact details": {
+        "sql": "SELECT patient_id, full_name, phone, address FROM patients WHERE patient_id = :patient_id",
+        "terms": ("phone", "address", "contact", "name"),
+    },
+    "treatments": {
+        "sql": "SELECT name, start_date FROM treatments WHERE patient_id = :patient_id ORDER BY start_date DESC LIMIT 100",
+        "terms": ("treatment", "treat", "therapy", "therapies", "medication", "medicine", "drug", "prescription",
+                  "prescribed"),
+    },
+    "pathology": {
+        "sql": ("SELECT report_date, diagnosis FROM pathology WHERE patient_id = :patient_id "
+                "ORDER BY report_date DESC LIMIT 100"),
+        "terms": ("pathology", "diagnosis", "diagnoses", "diagnosed", "biopsy", "tumor", "tumour", "cancer"),
+    },
+}
+
+# Reply the model gives when the snapshot does not contain the answer
+SNAPSHOT_MISS = "NOT_IN_SNAPSHOT"
+
+class PatientSnapshot(NamedTuple):
+    patient_id: str
+    sections: dict        # section name -> compact CSV result (or "Error: ..." if its query failed)
+    terms: dict           # section name -> question terms the section can answer
+    created: float        # time.monotonic() when the snapshot was taken
+    schema_version: int   # SchemaCache.version the snapshot was taken against
+
+    def covers(self, question):
+        """True if the question mentions (as a whole word) a topic of a section that loaded completely."""
+        words = set(re.findall(r"[a-z]+", (question or "").lower()))
+        return any(is_complete_result(self.sections[name])
+                   and any(word in words for term in self.terms.get(name, ()) for word in (term, f"{term}s", f"{term}es"))
+                   for name in self.sections)
+
+    def text(self):
+        """Render the sections that loaded completely, for the LLM prompt."""
+        return "\n\n".join(f"## {name}\n{result}" for name, result in self.sections.items()
+                           if is_complete_result(result))
+
+_PREFETCH_EXECUTOR = None
+_PREFETCH_EXECUTOR_LOCK = threading.Lock()
+
+def get_prefetch_executor(max_workers=4):
+    """Return the process-wide worker pool that takes snapshots in the background."""
+    global _PREFETCH_EXECUTOR
+    with _PREFETCH_EXECUTOR_LOCK:
+        if _PREFETCH_EXECUTOR is None:
+            _PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        return _PREFETCH_EXECUTOR
+
+def take_snapshot(uri, patient_id, queries=None, max_rows=20, max_cell_chars=200, token_budget=500):
+    """
+    Run the snapshot queries for one patient.
+
+    Parameters:
+    - uri: Database URI
+    - patient_id: The patient to snapshot
+    - queries: Section name -> {"sql": ..., "terms": (...)} (defaults to SNAPSHOT_QUERIES)
+    - max_rows / max_cell_chars / token_budget: Size limits per section, as in shape_result()
+
+    Returns:
+    - PatientSnapshot
+    """
+    queries = queries or SNAPSHOT_QUERIES
+    engine = get_engine(uri)
+    schema_cache = get_schema_cache(uri)
+    schema_cache.get()
+    schema_version = schema_cache.version
+    tracer = get_tracer()
+    sections = {}
+    for name, query in queries.items():
+        with tracer.span("db", f"snapshot:{name}") as attributes:
+            result = run_shaped_query(engine, query["sql"], {"patient_id": patient_id}, max_rows=max_rows,
+                                      max_cell_chars=max_cell_chars, token_budget=token_budget)
+            attributes["response_bytes"] = len(result.encode("utf-8"))
+            if result.startswith("Error"):
+                attributes["error"] = result.splitlines()[0]
+        sections[name] = result
+    return PatientSnapshot(str(patient_id), sections, {name: query.get("terms", ()) for name, query in queries.items()},
+                           time.monotonic(), schema_version)
+
+class SnapshotStore:
+    """
+    Per-session cache of patient snapshots, filled in the background.
+
+    prefetch() is called when a patient is selected; get() never blocks on
+    the database unless asked to wait. Snapshots expire after ttl seconds,
+    when the database schema changes, or when invalidate() is called.
+    Only the most recently used max_entries patients are kept.
+    """
+    def __init__(self, uri, queries=None, ttl=300, max_entries=8, executor=None):
+        self.uri = uri
+        self.queries = queries or SNAPSHOT_QUERIES
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.executor = executor or get_prefetch_executor()
+        self._snapshots = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _is_fresh(self, snapshot):
+        if time.monotonic() - snapshot.created > self.ttl:
+            return False
+        schema_cache = get_schema_cache(self.uri)
+        schema_cache.get()
+        return snapshot.schema_version == schema_cache.version
+
+    def _store(self, future):
+        snapshot = None
+        try:
+            snapshot = future.result()
+        except Exception as e:
+            print(f"Error prefetching patient snapshot: {str(e)}")
+        with self._lock:
+            for patient_id, pending in list(self._pending.items()):
+                if pending is future:
+                    del self._pending[patient_id]
+            if snapshot is not None:
+                self._snapshots.pop(snapshot.patient_id, None)
+                self._snapshots[snapshot.patient_id] = snapshot
+                while len(self._snapshots) > self.max_entries:
+                    self._snapshots.pop(next(iter(self._snapshots)))
+
+    def prefetch(self, patient_id):
+        """
+        Start taking a snapshot of the patient in the background, unless a fresh one is cached or already on its way.
+
+        Returns:
+        - Future of the PatientSnapshot, or None if a fresh snapshot is already cached
+        """
+        patient_id = str(patient_id)
+        with self._lock:
+            snapshot = self._snapshots.get(patient_id)
+            pending = self._pending.get(patient_id)
+        if pending is not None:
+            return pending
+        if snapshot is not None and self._is_fresh(snapshot):
+            return None
+        with self._lock:
+            pending = self._pending.get(patient_id)
+            if pending is not None:
+                return pending
+            pending = self._pending[patient_id] = self.executor.submit(take_snapshot, self.uri, patient_id, self.queries)
+        # Outside the lock, as the callback runs straight away if the snapshot is already done
+        pending.add_done_callback(self._store)
+        return pending
+
+    def get(self, patient_id, wait=0):
+        """
+        Return the cached snapshot of a patient, or None if there is no fresh one.
+
+        Parameters:
+        - patient_id: The patient
+        - wait: Seconds to wait for a snapshot that is still being taken
+        """
+        patient_id = str(patient_id)
+        with self._lock:
+            pending = self._pending.get(patient_id)
+        if pending is not None and wait:
+            try:
+                snapshot = pending.result(timeout=wait)
+            except Exception:
+                snapshot = None
+            if snapshot is not None and self._is_fresh(snapshot):
+                return snapshot
+        with self._lock:
+            snapshot = self._snapshots.get(patient_id)
+            if snapshot is not None:
+                # Most recently used patients are kept longest
+                self._snapshots[patient_id] = self._snapshots.pop(patient_id)
+        if snapshot is None or not self._is_fresh(snapshot):
+            return None
+        return snapshot
+
+    def invalidate(self, patient_id=None):
+        """Drop one patient's snapshot (e.g. after their record changed), or every snapshot."""
+        with self._lock:
+            if patient_id is None:
+                self._snapshots.clear()
+            else:
+                self._snapshots.pop(str(patient_id), None)
@@ -0,0 +1,749 @@
+import csv
+import io
+import re
+import threading
+from typing import NamedTuple
+from collections import OrderedDict
+from sqlalchemy import text
+
+# Words that carry no intent for plan-cache keys
+INTENT_STOPWORDS = {
+    "a", "an", "the", "of", "for", "to", "in", "on", "at", "by", "with", "and", "or",
+    "what", "which", "who", "when", "where", "how", "is", "are", "was", "were", "be",
+    "do", "does", "did", "has", "have", "had", "can", "could", "would", "please", "me",
+    "show", "tell", "give", "list", "get", "find", "patient", "patients", "this", "that",
+    "his", "her", "their", "he", "she", "they", "them", "i", "you", "my", "your", "any",
+}
+
+def normalize_intent(question, patient_id=None):
+    """
+    Reduce a question to a normalized intent key.
+
+    Lowercases, drops stopwords and the patient's own id, applies a crude
+    suffix stem and sorts the remaining words, so that "What treatments has
+    the patient had recently?" and "recent treatment" share a key. Other
+    numbers and quoted terms are kept, as they change the query: "last 5
+    treatments" and "last 50 treatments" must not share a plan.
+    """
+    words = set()
+    # Quotes only count when they open and close at word boundaries, so that the
+    # apostrophes of "patient's doctor's" are not read as a quoted term
+    pattern = r"(?<!\w)'[^']+'(?!\w)|(?<!\w)\"[^\"]+\"(?!\w)|\d+(?:\.\d+)?|[a-z]+(?:'[a-z]+)?"
+    for term in re.findall(pattern, (question or "").lower()):
+        if term[0] in "'\"":
+            words.add(term)
+            continue
+        # Possessives and contractions: "doctor's" -> "doctor", "don't" -> "dont"
+        term = term[:-2] if term.endswith("'s") else term.replace("'", "")
+        if term[0].isdigit():
+            if patient_id is None or term != str(patient_id).lower():
+                words.add(term)
+            continue
+        if term in INTENT_STOPWORDS:
+            continue
+        for suffix in ("ly", "es", "s"):
+            if term.endswith(suffix) and len(term) > len(suffix) + 3:
+                term = term[:-len(suffix)]
+                break
+        words.add(term)
+    return " ".join(sorted(words))
+
+def parameterize_patient(sql, patient_id):
+    """
+    Replace the patient_id literal in a query with a :patient_id bind parameter.
+
+    Returns:
+    - (template, quote) where quote is the quote character used around the
+      literal, or (None, None) if the literal could not be bound safely
+    """
+    patient_id = re.escape(str(patient_id))
+    pattern = re.compile(rf"(\b(?:\w+\.)?patient_id\s*=\s*)(['\"]?){patient_id}\2(?!\w)", re.IGNORECASE)
+    quotes = {match.group(2) for match in pattern.finditer(sql)}
+    if len(quotes) != 1:
+        return None, None
+    template = pattern.sub(r"\1:patient_id", sql)
+    # Any other occurrence of the id means the query is not purely parameterized
+    if re.search(rf"(?<![\w.]){patient_id}(?![\w.])", template):
+        return None, None
+    return template, quotes.pop()
+
+def has_fixed_literals(template):
+    """
+    True if a parameterized query still contains string, date or number literals.
+
+    Only the row count (and offset) of a LIMIT clause may remain, as the
+    patient_id is bound as a parameter. Other literals come from the wording
+    of the question the plan was learnt from, so the plan cannot be reused.
+    """
+    tokens = tokenize_sql(template)
+    words = [token.text.upper() if token.kind == "word" else token.text for token in tokens]
+    for index, token in enumerate(tokens):
+        if token.kind == "string":
+            return True
+        if token.kind != "number":
+            continue
+        # LIMIT n / LIMIT offset, n / OFFSET m
+        if words[index - 1] in ("LIMIT", "OFFSET") or (words[index - 1] == "," and words[index - 3] == "LIMIT"):
+            continue
+        return True
+    return False
+
+def render_plan(template, quote, patient_id):
+    """Render a cached plan with the patient literal inlined, for display to the model."""
+    return template.replace(":patient_id", f"{quote}{patient_id}{quote}")
+
+class PlanCache:
+    """
+    LRU cache of validated SQL plans keyed by normalized question intent.
+
+    Plans are stored with patient_id as a bind parameter, so a plan learnt for
+    one patient can be executed directly for any other. The cache is cleared
+    whenever the schema version it was filled against changes.
+    """
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._plans = OrderedDict()
+        self._schema_version = None
+        self._lock = threading.Lock()
+
+    def sync_schema(self, schema_version):
+        """Drop every plan if the schema has changed since they were stored."""
+        with self._lock:
+            if schema_version != self._schema_version:
+                self._plans.clear()
+                self._schema_version = schema_version
+
+    def get(self, question, patient_id=None):
+        """
+        Look up the plan for a question.
+
+        Returns:
+        - (template, quote) tuple, or None on a miss
+        """
+        key = normalize_intent(question, patient_id)
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is None:
+                self.misses += 1
+                return None
+            self._plans.move_to_end(key)
+            self.hits += 1
+            return plan
+
+    def put(self, question, sql, patient_id):
+        """
+        Store the plan for a question.
+
+        Queries that cannot be parameterized, or that keep other literals from
+        the question (see has_fixed_literals()), are skipped.
+        """
+        key = normalize_intent(question, patient_id)
+        template, quote = parameterize_patient(sql, patient_id)
+        if not key or template is None or has_fixed_literals(template):
+            return False
+        with self._lock:
+            self._plans[key] = (template, quote)
+            self._plans.move_to_end(key)
+            while len(self._plans) > self.max_entries:
+                self._plans.popitem(last=False)
+        return True
+
+    def invalidate(self):
+        with self._lock:
+            self._plans.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._plans),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+_PLAN_CACHES = {}
+_PLAN_CACHE_LOCK = threading.Lock()
+
+def get_plan_cache(uri):
+    """Return the shared PlanCache for a database URI."""
+    with _PLAN_CACHE_LOCK:
+        cache = _PLAN_CACHES.get(uri)
+        if cache is None:
+            cache = _PLAN_CACHES[uri] = PlanCache()
+        return cache
+
+# Local SQL validation
+# Statements and clauses that must never reach the database
+FORBIDDEN_KEYWORDS = {
+    "INSERT", "UPDATE", "DELETE", "DROP", "ALTER", "CREATE", "TRUNCATE", "MERGE", "GRANT",
+    "REVOKE", "CALL", "EXEC", "EXECUTE", "SET", "LOCK", "UNLOCK", "RENAME", "HANDLER",
+    "ATTACH", "DETACH", "PRAGMA", "VACUUM", "OUTFILE", "DUMPFILE",
+}
+# Keywords that are only harmful when used as a statement (REPLACE(...) is a string function)
+FORBIDDEN_STATEMENTS = {"REPLACE", "LOAD"}
+FORBIDDEN_FUNCTIONS = {"SLEEP", "BENCHMARK", "LOAD_FILE"}
+
+# Target types accepted by CAST/CONVERT, per dialect (None means any type name is accepted)
+CAST_TYPES = {
+    "mysql": {"BINARY", "CHAR", "DATE", "DATETIME", "DECIMAL", "DOUBLE", "FLOAT", "JSON",
+              "NCHAR", "REAL", "SIGNED", "UNSIGNED", "TIME", "YEAR"},
+    "sqlite": None,
+}
+
+# Dialects whose row limit is expressed as a trailing LIMIT clause
+LIMIT_DIALECTS = {"mysql", "sqlite", "postgresql"}
+
+_CLAUSE_KEYWORDS = {
+    "WHERE", "JOIN", "INNER", "LEFT", "RIGHT", "FULL", "CROSS", "OUTER", "ON", "USING", "GROUP",
+    "ORDER", "HAVING", "LIMIT", "UNION", "EXCEPT", "INTERSECT", "NATURAL", "STRAIGHT_JOIN",
+}
+
+_TOKEN_PATTERN = re.compile(r"""
+      (?P<string>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.)*")
+    | (?P<comment>--[^\n]*|\#[^\n]*|/\*[\s\S]*?\*/)
+    | (?P<quoted>`[^`]*`)
+    | (?P<number>\d+(?:\.\d+)?)
+    | (?P<word>[A-Za-z_][\w$]*)
+    | (?P<symbol><>|!=|<=|>=|\S)
+    | (?P<space>\s+)
+""", re.VERBOSE)
+
+class Token(NamedTuple):
+    kind: str    # string, quoted, number, word or symbol
+    text: str
+    start: int   # offset in the query
+
+def tokenize_sql(sql):
+    """Split SQL into Tokens, skipping whitespace and comments."""
+    return [Token(match.lastgroup, match.group(), match.start())
+            for match in _TOKEN_PATTERN.finditer(sql)
+            if match.lastgroup not in ("space", "comment")]
+
+def strip_sql_comments(sql):
+    """Remove comments (outside of string literals) from a query."""
+    return _TOKEN_PATTERN.sub(lambda match: " " if match.lastgroup == "comment" else match.group(), sql)
+
+# Keywords that end the FROM clause / the WHERE clause of a SELECT
+_FROM_END_KEYWORDS = {"WHERE", "GROUP", "ORDER", "HAVING", "LIMIT", "WINDOW"}
+_WHERE_END_KEYWORDS = {"GROUP", "ORDER", "HAVING", "LIMIT", "WINDOW"}
+_JOIN_KEYWORDS = {"JOIN", "INNER", "LEFT", "RIGHT", "FULL", "CROSS", "NATURAL", "STRAIGHT_JOIN", ","}
+_SET_OPERATORS = {"UNION", "EXCEPT", "INTERSECT"}
+
+class _PatientScope:
+    """
+    Check that a query only reads the selected patient's rows.
+
+    Every SELECT that reads a patient table (one with a patient_id column, or
+    any table if the columns are unknown) must have patient_id = <patient>
+    (or IN a list of only that patient) as a top-level AND condition of its
+    WHERE clause. This applies to each UNION/EXCEPT/INTERSECT branch and to
+    every subquery. Other patient tables of the same SELECT must be joined to
+    a filtered one on patient_id. A WHERE clause with a top-level OR never
+    counts as scoped, as the OR can let any row through.
+    """
+    def __init__(self, tokens, words, patient_id, patient_tables=None):
+        self.tokens = tokens
+        self.words = words
+        self.names = [token.text.strip("`").lower() if token.kind in ("word", "quoted") else None for token in tokens]
+        self.patient_id = str(patient_id)
+        self.patient_tables = patient_tables
+        # Common table expressions are not tables of their own; their bodies are checked as subqueries
+        self.ctes = {self.names[index] for index in range(1, len(words) - 2)
+                     if words[index - 1] in ("WITH", ",") and words[index + 1] == "AS" and words[index + 2] == "("}
+        self.filtered = False
+        self.match = {}
+        self.balanced = True
+        stack = []
+        for index, word in enumerate(words):
+            if word == "(":
+                stack.append(index)
+            elif word == ")":
+                if not stack:
+                    self.balanced = False
+                    break
+                self.match[stack.pop()] = index
+        if stack:
+            self.balanced = False
+
+    def check(self):
+        # At least one SELECT has to be filtered on the patient, even if no patient table is known
+        return self.balanced and self._query_scoped(0, len(self.words)) and self.filtered
+
+    def _outside_parentheses(self, start, end):
+        """Indexes of the tokens in [start, end) that are not inside parentheses."""
+        index = start
+        while index < end:
+            if self.words[index] == "(":
+                index = self.match[index] + 1
+            else:
+                yield index
+                index += 1
+
+    def _groups(self, start, end):
+        """(open, close) indexes of the parenthesized groups directly inside [start, end)."""
+        index = start
+        while index < end:
+            if self.words[index] == "(":
+                yield index, self.match[index]
+                index = self.match[index] + 1
+            else:
+                index += 1
+
+    def _expression_scoped(self, start, end, outer):
+        if start < end and self.words[start] in ("SELECT", "WITH"):
+            return self._query_scoped(start, end, outer)
+        return all(self._expression_scoped(open_index + 1, close_index, outer)
+                   for open_index, close_index in self._groups(start, end))
+
+    def _query_scoped(self, start, end, outer=frozenset()):
+        """
+        Check a query and its subqueries; outer holds the filtered aliases of the enclosing
+        queries, which a correlated subquery may join to.
+        """
+        branch_start = start
+        for index in [*self._outside_parentheses(start, end), end]:
+            if index == end or self.words[index] in _SET_OPERATORS:
+                scoped, filtered = self._select_scoped(branch_start, index, outer)
+                # Subqueries, CTE bodies and parenthesized UNION branches
+                if not scoped or not all(self._expression_scoped(open_index + 1, close_index, filtered)
+                                         for open_index, close_index in self._groups(branch_start, index)):
+                    return False
+                branch_start = index + 1
+        return True
+
+    def _clause_end(self, start, end, keywords):
+        return next((index for index in self._outside_parentheses(start, end) if self.words[index] in keywords), end)
+
+    def _conjuncts(self, start, end):
+        """
+        Split a condition on its top-level ANDs.
+
+        Returns:
+        - List of (start, end) ranges, or None if the condition has a top-level OR
+        """
+        conjuncts = []
+        conjunct_start = start
+        between = False
+        for index in self._outside_parentheses(start, end):
+            word = self.words[index]
+            if word in ("OR", "XOR", "|"):
+                return None
+            if word == "BETWEEN":
+                between = True
+            elif word == "AND":
+                # The AND of "BETWEEN x AND y" does not separate conditions
+                if between:
+                    between = False
+                    continue
+                conjuncts.append((conjunct_start, index))
+                conjunct_start = index + 1
+        conjuncts.append((conjunct_start, end))
+        result = []
+        for conjunct_start, conjunct_end in conjuncts:
+            # Unwrap (condition)
+            while (conjunct_end - conjunct_start > 2 and self.words[conjunct_start] == "("
+                   and self.match[conjunct_start] == conjunct_end - 1):
+                conjunct_start, conjunct_end = conjunct_start + 1, conjunct_end - 1
+            result.append((conjunct_start, conjunct_end))
+        return result
+
+    def _column(self, start, end):
+        """The qualifier of a [qualifier.]patient_id reference spanning [start, end), "" if unqualified, else None."""
+        if end - start == 1 and self.names[start] == "patient_id":
+            return ""
+        if end - start == 3 and self.words[start + 1] == "." and self.names[start] is not None and self.names[start + 2] == "patient_id":
+            return self.names[start]
+        return None
+
+    def _is_patient(self, index):
+        token = self.tokens[index]
+        if token.kind == "number":
+            return token.text == self.patient_id
+        return token.kind == "string" and token.text[1:-1] == self.patient_id
+
+    def _patient_filter(self, start, end):
+        """The qualifier filtered by a patient_id = <patient> condition ("" if unqualified), else None."""
+        words = self.words
+        if end - start >= 2 and words[end - 2] == "=" and self._is_patient(end - 1):
+            return self._column(start, end - 2)
+        if end - start >= 2 and words[start + 1] == "=" and self._is_patient(start):
+            return self._column(start + 2, end)
+        # patient_id IN (<patient>, ...): every value has to be the patient
+        if end - start >= 4 and words[end - 1] == ")" and words[self._open(end - 1) - 1] == "IN":
+            open_index = self._open(end - 1)
+            values = range(open_index + 1, end - 1)
+            if not values or not all(self._is_patient(index) if (index - open_index) % 2 else words[index] == ","
+                                     for index in values) or words[end - 2] == ",":
+                return None
+            return self._column(start, open_index - 1)
+        return None
+
+    def _open(self, close_index):
+        return next(open_index for open_index, index in self.match.items() if index == close_index)
+
+    def _join_columns(self, start, end):
+        """The two qualifiers of an a.patient_id = b.patient_id condition, else None."""
+        for index in range(start, end):
+            if self.words[index] == "=":
+                left, right = self._column(start, index), self._column(index + 1, end)
+                if left and right:
+                    return left, right
+                return None
+        return None
+
+    def _select_scoped(self, start, end, outer):
+        """
+        Check one SELECT (without its subqueries).
+
+        Returns:
+        - (scoped, filtered aliases visible to its subqueries, including unshadowed outer ones)
+        """
+        words, names = self.words, self.names
+        from_index = next((index for index in self._outside_parentheses(start, end) if words[index] == "FROM"), None)
+        if from_index is None:
+            return True, outer
+        from_end = self._clause_end(from_index + 1, end, _FROM_END_KEYWORDS)
+        aliases = {}     # alias -> table name (None for derived tables)
+        joins = []       # pairs of aliases joined on patient_id
+        index = from_index + 1
+        expect_table = True
+        while index < from_end:
+            word = words[index]
+            if expect_table and (word == "(" or names[index] is not None):
+                if word == "(":
+                    # Derived table; the subquery itself is checked separately
+                    table = None
+                    index = self.match[index] + 1
+                else:
+                    # schema.table
+                    if index + 2 < from_end and words[index + 1] == "." and names[index + 2] is not None:
+                        index += 2
+                    table = names[index]
+                    index += 1
+                alias = table
+                if index < from_end and words[index] == "AS":
+                    index += 1
+                if index < from_end and names[index] is not None and words[index] not in _CLAUSE_KEYWORDS:
+                    alias = names[index]
+                    index += 1
+                if alias is not None:
+                    aliases[alias] = table
+                expect_table = False
+                continue
+            if word in ("JOIN", "STRAIGHT_JOIN", ","):
+                expect_table = True
+            elif word == "ON":
+                condition_end = self._clause_end(index + 1, from_end, _JOIN_KEYWORDS)
+                for conjunct_start, conjunct_end in self._conjuncts(index + 1, condition_end) or []:
+                    pair = self._join_columns(conjunct_start, conjunct_end)
+                    if pair:
+                        joins.append(pair)
+                index = condition_end
+                continue
+            elif word == "USING" and index + 1 < from_end and words[index + 1] == "(":
+                close_index = self.match[index + 1]
+                if "patient_id" in names[index + 2:close_index]:
+                    joined = list(aliases)
+                    joins.extend((joined[-1], alias) for alias in joined[:-1])
+                index = close_index + 1
+                continue
+            index += 1
+
+        patient_aliases = {alias for alias, table in aliases.items()
+                           if table is not None and table not in self.ctes
+                           and (self.patient_tables is None or table in self.patient_tables)}
+        # Filtered aliases of the enclosing queries, unless an alias here shadows them
+        outer = {alias for alias in outer if alias not in aliases}
+        where_index = from_end if from_end < end and words[from_end] == "WHERE" else None
+        if where_index is None:
+            return not patient_aliases, outer
+        conjuncts = self._conjuncts(where_index + 1, self._clause_end(where_index + 1, end, _WHERE_END_KEYWORDS))
+        if conjuncts is None:
+            return not patient_aliases, outer
+        filtered = set()
+        for conjunct_start, conjunct_end in conjuncts:
+            qualifier = self._patient_filter(conjunct_start, conjunct_end)
+            if qualifier == "":
+                # An unqualified patient_id is ambiguous unless only one table has it
+                filtered.update(patient_aliases or aliases)
+            elif qualifier is not None and qualifier in aliases:
+                filtered.add(qualifier)
+            else:
+                pair = self._join_columns(conjunct_start, conjunct_end)
+                if pair:
+                    joins.append(pair)
+        if filtered:
+            self.filtered = True
+        # Tables joined on patient_id to a filtered table are filtered too, including
+        # a correlated subquery's join to an already filtered alias of an outer query
+        filtered |= outer
+        changed = True
+        while changed:
+            changed = False
+            for left, right in joins:
+                if (left in filtered) != (right in filtered):
+                    filtered.update((left, right))
+                    changed = True
+        return patient_aliases <= filtered, filtered
+
+class ValidationResult(NamedTuple):
+    ok: bool
+    sql: str          # the (possibly rewritten) query to run
+    errors: list      # human readable problems, fed back to the model when not ok
+
+class SQLValidator:
+    """
+    Deterministic, local replacement for the LLM check_query step.
+
+    Rejects anything but a single SELECT, enforces the top_k LIMIT, requires the
+    query to be scoped to the selected patient and catches common pitfalls
+    (NOT IN subqueries, invalid cast types, unknown tables and columns).
+    """
+    def __init__(self, dialect, columns=None, top_k=100):
+        self.dialect = dialect
+        self.columns = {table.lower(): {column.lower() for column in names} for table, names in (columns or {}).items()}
+        self.top_k = top_k
+
+    @property
+    def supported(self):
+        return self.dialect in LIMIT_DIALECTS
+
+    def validate(self, sql, patient_id=None):
+        """
+        Validate a generated query.
+
+        Parameters:
+        - sql: The query produced by the model
+        - patient_id: The selected patient; the query must filter on it
+
+        Returns:
+        - ValidationResult
+        """
+        sql = strip_sql_comments(sql).strip().rstrip(";").strip()
+        tokens = tokenize_sql(sql)
+        if not tokens:
+            return ValidationResult(False, sql, ["The query is empty."])
+
+        errors = []
+        words = [token.text.upper() if token.kind == "word" else token.text for token in tokens]
+        if ";" in words:
+            errors.append("Only a single statement is allowed.")
+        if words[0] not in ("SELECT", "WITH"):
+            errors.append("Only SELECT statements are allowed.")
+        forbidden = set()
+        for index, (token, word) in enumerate(zip(tokens, words)):
+            if token.kind != "word":
+                continue
+            is_call = index + 1 < len(words) and words[index + 1] == "("
+            if word in FORBIDDEN_KEYWORDS or (word in FORBIDDEN_STATEMENTS and not is_call) or (word in FORBIDDEN_FUNCTIONS and is_call):
+                forbidden.add(word)
+        if forbidden:
+            errors.append(f"Forbidden keywords: {', '.join(sorted(forbidden))}.")
+        if patient_id is not None and not self._is_patient_scoped(tokens, words, patient_id):
+            errors.append(f"The query must filter on patient_id = {patient_id}.")
+        errors.extend(self._check_pitfalls(tokens, words))
+        if errors:
+            return ValidationResult(False, sql, errors)
+        return ValidationResult(True, self._enforce_limit(sql, tokens, words), [])
+
+    def _is_patient_scoped(self, tokens, words, patient_id):
+        patient_tables = {table for table, names in self.columns.items() if "patient_id" in names} if self.columns else None
+        return _PatientScope(tokens, words, patient_id, patient_tables).check()
+
+    def _check_pitfalls(self, tokens, words):
+        errors = []
+        for index in range(len(words) - 3):
+            if words[index:index + 4] == ["NOT", "IN", "(", "SELECT"]:
+                errors.append("NOT IN with a subquery returns no rows if the subquery yields NULL; use NOT EXISTS instead.")
+        cast_types = CAST_TYPES.get(self.dialect)
+        if cast_types is not None:
+            for index, word in enumerate(words[:-1]):
+                if word == "AS" and self._in_cast(words, index) and words[index + 1] not in cast_types:
+                    errors.append(f"Cannot CAST to {tokens[index + 1].text} in {self.dialect}; use one of {', '.join(sorted(cast_types))}.")
+        if self.columns:
+            errors.extend(self._check_identifiers(tokens, words))
+        return errors
+
+    @staticmethod
+    def _in_cast(words, as_index):
+        depth = 0
+        for index in range(as_index - 1, -1, -1):
+            if words[index] == ")":
+                depth += 1
+            elif words[index] == "(":
+                if depth == 0:
+                    return index > 0 and words[index - 1] in ("CAST", "CONVERT")
+                depth -= 1
+        return False
+
+    def _check_identifiers(self, tokens, words):
+        errors = []
+        names = [token.text.strip("`").lower() for token in tokens]
+        is_name = [token.kind in ("word", "quoted") for token in tokens]
+        # Common table expressions are valid table names too
+        ctes = {names[index] for index in range(1, len(words) - 1)
+                if words[index + 1] == "AS" and words[index - 1] in ("WITH", ",") and is_name[index]}
+        # FROM inside function parentheses (EXTRACT(YEAR FROM d), TRIM(LEADING ' ' FROM s)) is not a table reference
+        in_query = []
+        opened_by_query = []
+        for index, word in enumerate(words):
+            in_query.append(not opened_by_query or opened_by_query[-1])
+            if word == "(":
+                opened_by_query.append(index + 1 < len(words) and words[index + 1] in ("SELECT", "WITH"))
+            elif word == ")" and opened_by_query:
+                opened_by_query.pop()
+        aliases = {}
+        for index, word in enumerate(words[:-1]):
+            if word not in ("FROM", "JOIN") or not is_name[index + 1] or not in_query[index]:
+                continue
+            table_index = index + 1
+            # schema.table
+            if table_index + 2 < len(words) and words[table_index + 1] == "." and is_name[table_index + 2]:
+                table_index += 2
+            table = names[table_index]
+            if table not in self.columns and table not in ctes:
+                errors.append(f"Unknown table: {tokens[table_index].text}.")
+                continue
+            aliases[table] = table
+            alias_index = table_index + 2 if table_index + 1 < len(words) and words[table_index + 1] == "AS" else table_index + 1
+            if alias_index < len(tokens) and is_name[alias_index] and words[alias_index] not in _CLAUSE_KEYWORDS:
+                aliases[names[alias_index]] = table
+        for index in range(1, len(tokens) - 1):
+            if words[index] == "." and is_name[index - 1] and is_name[index + 1]:
+                table = aliases.get(names[index - 1])
+                if table in self.columns and names[index + 1] not in self.columns[table]:
+                    errors.append(f"Unknown column: {tokens[index - 1].text}.{tokens[index + 1].text}.")
+        return errors
+
+    def _enforce_limit(self, sql, tokens, words):
+        if not self.supported:
+            return sql
+        depth = 0
+        limit_index = None
+        for index, word in enumerate(words):
+            if word == "(":
+                depth += 1
+            elif word == ")":
+                depth -= 1
+            elif word == "LIMIT" and depth == 0:
+                limit_index = index
+        if limit_index is None:
+            return f"{sql} LIMIT {self.top_k}"
+        # LIMIT n / LIMIT n OFFSET m / LIMIT offset, n (MySQL)
+        offset_first = limit_index + 2 < len(words) and words[limit_index + 2] == ","
+        count_index = limit_index + 3 if offset_first else limit_index + 1
+        if count_index < len(tokens) and tokens[count_index].kind == "number":
+            if float(tokens[count_index].text) <= self.top_k:
+                return sql
+            # Clamp only the row count, so any offset still applies
+            count = tokens[count_index]
+            return f"{sql[:count.start]}{self.top_k}{sql[count.start + len(count.text):]}"
+        # Not a plain number (LIMIT ALL, a parameter...): replace the clause, keeping a numeric offset
+        offset = None
+        if offset_first and tokens[limit_index + 1].kind == "number":
+            offset = tokens[limit_index + 1].text
+        for index in range(limit_index + 1, len(words) - 1):
+            if words[index] == "OFFSET" and tokens[index + 1].kind == "number":
+                offset = tokens[index + 1].text
+        clause = f"LIMIT {self.top_k}" + (f" OFFSET {offset}" if offset is not None else "")
+        return f"{sql[:tokens[limit_index].start].rstrip()} {clause}"
+
+# Query result shaping
+def estimate_tokens(text):
+    """Rough token count (about four characters per token) used for result budgets."""
+    return len(text) // 4 + 1
+
+def _truncate_cell(value, max_cell_chars):
+    text_value = "" if value is None else str(value)
+    if len(text_value) <= max_cell_chars:
+        return text_value, False
+    return f"{text_value[:max_cell_chars]}...[+{len(text_value) - max_cell_chars} chars]", True
+
+# Notes shape_result() adds when it had to leave rows out or cut cells short
+MORE_ROWS_NOTE = "more rows exist beyond the result budget"
+TRUNCATED_CELLS_NOTE = "were truncated in"
+
+def is_complete_result(result):
+    """True if a shape_result() text holds every row in full (False for 'Error: ...' results too)."""
+    note = result.rsplit("\n", 1)[-1]
+    return note.startswith("-- ") and MORE_ROWS_NOTE not in note and TRUNCATED_CELLS_NOTE not in note
+
+def shape_result(columns, rows, max_rows=100, max_cell_chars=200, token_budget=2000):
+    """
+    Encode query results compactly for the model.
+
+    Rows are written as CSV under a single header line. Long cells are
+    truncated, and rows stop once max_rows or the token budget is reached.
+    Whenever something is cut, a trailing note says what, so the model can
+    refine the query (filters, aggregates, fewer columns) instead.
+
+    Parameters:
+    - columns: Column names
+    - rows: Iterable of row tuples; it is only consumed as far as needed
+    - max_rows: Maximum rows to include
+    - max_cell_chars: Maximum characters per cell
+    - token_budget: Approximate token budget for the encoded result
+
+    Returns:
+    - The encoded result text
+    """
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(columns)
+    used_tokens = estimate_tokens(output.getvalue())
+    shown = 0
+    truncated_columns = {}
+    more_rows = False
+    for row in rows:
+        if shown >= max_rows:
+            more_rows = True
+            break
+        cells, row_truncated = [], []
+        for column, value in zip(columns, row):
+            cell, truncated = _truncate_cell(value, max_cell_chars)
+            if truncated:
+                row_truncated.append(column)
+            cells.append(cell)
+        line = io.StringIO()
+        csv.writer(line, lineterminator="\n").writerow(cells)
+        line_tokens = estimate_tokens(line.getvalue())
+        if shown and used_tokens + line_tokens > token_budget:
+            more_rows = True
+            break
+        for column in row_truncated:
+            truncated_columns[column] = truncated_columns.get(column, 0) + 1
+        output.write(line.getvalue())
+        used_tokens += line_tokens
+        shown += 1
+
+    notes = [f"-- {shown} row(s) shown"]
+    if more_rows:
+        notes.append(f"{MORE_ROWS_NOTE}; add filters, aggregates or a smaller LIMIT to see them")
+    if truncated_columns:
+        details = ", ".join(f"{column} ({count})" for column, count in truncated_columns.items())
+        notes.append(f"cells longer than {max_cell_chars} chars {TRUNCATED_CELLS_NOTE}: {details}; select substrings or fewer columns")
+    return output.getvalue() + "; ".join(notes)
+
+def run_shaped_query(engine, sql, parameters=None, fetch_size=50, **limits):
+    """
+    Run a query through a streaming (server-side) cursor and return the shaped result.
+
+    Rows are fetched fetch_size at a time and fetching stops as soon as the
+    shape_result limits are reached. Errors are returned as 'Error: ...' text,
+    like the LangChain SQL query tool, so the model can correct the query.
+    """
+    try:
+        with engine.connect() as connection:
+            result = connection.execution_options(stream_results=True, max_row_buffer=fetch_size).execute(
+                text(sql), parameters or {})
+            try:
+                if not result.returns_rows:
+                    return "-- the statement returned no rows"
+                rows = (tuple(row) for partition in result.partitions(fetch_size) for row in partition)
+                return shape_result(list(result.keys()), rows, **limits)
+            finally:
+                result.close()
+    except Exception as e:
+        return f"Error: {e}"
@@ -1,15 +1,45 @@
-import os
 import time
-import asyncio
+_IMPORT_STARTED = time.perf_counter()
+import os
+import uuid
 import streamlit as st
 from streamlit.components.v1 import html
 from streamlit_chat_widget import chat_input_widget
 from streamlit_float import *
-from google import genai
-from groq import Groq
-import boto3
-from agent_utilities import DatabaseAgent
-from llm_utilities import transcribe_audio, synthesize_speech,save_audio_file
+from client_utilities import get_genai_client, get_polly_client, record_startup, startup_seconds
+from executor_utilities import ExecutorBusy, get_question_executor
+from llm_utilities import transcribe_audio, SpeechPipeline, get_speech_cache
+from metrics_utilities import get_tracer
+# Heavy SDKs (google-genai, boto3, SQLAlchemy via db_utilities, langchain/langgraph via agent_utilities)
+# are imported on first use
+
+# Streamlit re-executes this script on every interaction, but the modules stay imported:
+# only the first run in a process pays for the imports, so only that run is recorded
+record_startup("app imports", time.perf_counter() - _IMPORT_STARTED)
+
+# Database holding the patient directory (defaults to the same placeholder MySQL credentials as DatabaseAgent)
+PATIENT_DB_URI = os.environ.get("PATIENT_DB_URI", "mysql+pymysql://user_name:password@db_host:3306/db_name")
+
+# Spans are appended to TRACE_JSONL and the Prometheus text is rewritten to PROMETHEUS_FILE
+# after every chat turn, when these are set
+tracer = get_tracer(jsonl_path=os.environ.get("TRACE_JSONL"))
+PROMETHEUS_FILE = os.environ.get("PROMETHEUS_FILE")
+
+# SQLite file with the agent's conversation checkpoints, how long idle conversations are kept
+# (they hold patient data), and how many chat messages are rendered
+CHECKPOINT_PATH = os.environ.get("CHECKPOINT_DB", "checkpoints.sqlite")
+CHECKPOINT_RETENTION_SECONDS = float(os.environ.get("CHECKPOINT_RETENTION_DAYS", "7")) * 24 * 3600
+HISTORY_WINDOW = 20
+
+# Progress labels shown while the agent runs, keyed by graph node
+NODE_STATUS_LABELS = {
+    "determine_query_type": "Understanding the question...",
+    "answer_from_snapshot": "Reading the patient summary...",
+    "lookup_plan": "Looking for a known query...",
+    "generate_query": "Writing the query...",
+    "check_query": "Checking the query...",
+    "run_query": "Querying the patient record...",
+}
 
 def _get_session():
     from streamlit.runtime import get_instance
@@ -20,7 +50,45 @@ def _get_session():
     # if session_info is None:
     #     raise RuntimeError("Couldn't get your Streamlit Session object.")
     return session_id
+
+def remember_message(history, role, content):
+    """Add a message to the rendered chat history, keeping only the most recent HISTORY_WINDOW."""
+    history["messages"].append({"role": role, "content": content})
+    history["total"] += 1
+    del history["messages"][:-HISTORY_WINDOW]
+
+def show_metrics(trace_id):
+    """Show the timed steps of the last chat turn and the per-step totals, with export buttons."""
+    spans = tracer.spans(trace_id) if trace_id else []
+    if spans:
+        st.subheader("Last turn")
+        turn_started = min(span["started"] for span in spans)
+        st.dataframe([{
+            "step": f"{span['kind']}:{span['name']}",
+            "start (ms)": round((span["started"] - turn_started) * 1000),
+            "time (ms)": round(span["seconds"] * 1000),
+            "tokens in/out": f"{span.get('input_tokens', 0)}/{span.get('output_tokens', 0)}",
+            "bytes in/out": f"{span.get('request_bytes', 0)}/{span.get('response_bytes', 0)}",
+            "error": span.get("error", ""),
+        } for span in spans], hide_index=True)
+    summary = tracer.summary()
+    if summary:
+        st.subheader("Since start-up")
+        st.dataframe([{
+            "step": f"{row['kind']}:{row['name']}",
+            "count": row["count"],
+            "errors": row["errors"],
+            "mean (ms)": round(row["mean_seconds"] * 1000),
+            "total (s)": round(row["seconds"], 2),
+            "tokens in/out": f"{row['input_tokens']}/{row['output_tokens']}",
+        } for row in summary], hide_index=True)
+        st.download_button("Download traces (JSON lines)", tracer.export_jsonl(), file_name="traces.jsonl",
+                           mime="application/x-ndjson")
+        st.download_button("Download metrics (Prometheus)", tracer.prometheus_text(), file_name="metrics.prom",
+                           mime="text/plain")
+
 def main():
+    rerun_started = time.perf_counter()
         
     # --- Streamlit UI Setup ---
     st.set_page_config(layout="wide") # Use wide layout for better chat display
@@ -37,37 +105,59 @@ def main():
         
         st.markdown("---")
         st.header("Patient Selection")
-        # Patient selection dropdown
-        # Using a placeholder for the dropdown to avoid showing it when no patients are available
-        # In a real application, you would fetch this list from a database or API
+        # Patients are looked up in the database with an indexed prefix search,
+        # one page at a time, instead of loading the whole table into the dropdown
+        # SQLAlchemy takes ~0.4 s to import, so it is only loaded once the page has started rendering
+        started = time.perf_counter()
+        from db_utilities import get_patient_directory
+        record_startup("db_utilities import", time.perf_counter() - started)
+        patient_directory = get_patient_directory(PATIENT_DB_URI)
+        patient_search = st.text_input("Search patients", placeholder="Name prefix or patient ID",
+                                       help="Search by the start of the patient's name, or by exact patient ID.")
+        # Stack of keyset cursors, one per page visited for the current search
+        if st.session_state.get("patient_search") != patient_search:
+            st.session_state["patient_search"] = patient_search
+            st.session_state["patient_cursors"] = [None]
+        cursors = st.session_state["patient_cursors"]
+        try:
+            patients, next_cursor = patient_directory.search(patient_search, cursor=cursors[-1])
+        except Exception as e:
+            st.error(f"Failed to load patients: {e}")
+            patients, next_cursor = [], None
+        options = [f"{patient_id}#{name}" for patient_id, name in patients]
+        selected = st.session_state.get("selected_patient")
+        if selected and selected not in options:
+            # Keep the current patient selectable while browsing other pages
+            options.insert(0, selected)
         option = st.selectbox(
             "Which patient would you like to look up?",
-            ["132#Kate Ann Evans", 
-             "133#Daniel John Thomas", 
-             "134#Emily George Walker",
-             "135#Daniel Kevin White",
-             "136#Daniel David Jackson",
-             "143#Alexander Michael Lewis",
-             "157#Aiden Nicholas Baker",
-             "168#Aiden Juan Green",
-             "174#Luna Timothy Flores",
-             "178#Luna Stephen Wright"],
-            index=None,
+            options,
+            index=options.index(selected) if selected in options else None,
             placeholder="Select a patient to chat with",
             help="Select a patient to chat with. The ID is used for backend operations.",
         )
+        st.session_state["selected_patient"] = option
+        previous_column, next_column = st.columns(2)
+        if previous_column.button("Previous", disabled=len(cursors) == 1, use_container_width=True):
+            cursors.pop()
+            st.rerun()
+        if next_column.button("Next", disabled=next_cursor is None, use_container_width=True):
+            cursors.append(next_cursor)
+            st.rerun()
         st.write("You selected:", option)
         st.markdown("---")
         st.header("Debug Info")
         show_debug = st.checkbox("Show Debug Info", value=False)
+        timing_placeholder = st.empty()
     
     # st.markdown("---")
     # --- API Key Validation and Client Initialization ---
     # Check if API keys are provided
     if GOOGLE_API_KEY: #and GROQ_API_KEY:
         try:
-            genai_client = genai.Client(api_key=GOOGLE_API_KEY)
-            # groq_client  = Groq(api_key=GROQ_API_KEY)
+            # Clients are cached per process and reused across reruns and sessions
+            genai_client = get_genai_client(GOOGLE_API_KEY)
+            # groq_client  = get_groq_client(GROQ_API_KEY)
         except Exception as e:
             st.error(f"Failed to initialize Gemini client: {e}")
             st.info("Please check your API key.")
@@ -78,25 +168,49 @@ def main():
         st.stop() # Stop execution if no API key
     
     # Create a client for Amazon Polly
-    polly_client = boto3.client('polly', 
-                        aws_access_key_id="key_id", 
-                        aws_secret_access_key="secret_key",
-                        region_name="region_name") # Replace with your AWS credentials and region
+    polly_client = get_polly_client(aws_access_key_id="key_id", 
+                                    aws_secret_access_key="secret_key",
+                                    region_name="region_name") # Replace with your AWS credentials and region
         
     if option:
         patient_id = option.split("#")[0] # Extract user ID from the selected option
         st.session_state["user_id"] = patient_id # Store user ID in session state for later use
+        # The selected patient's treatments, pathology and contact details are fetched in the
+        # background, so that most questions can be answered without the SQL agent loop
+        if "patient_snapshots" not in st.session_state:
+            from snapshot_utilities import SnapshotStore
+            st.session_state["patient_snapshots"] = SnapshotStore(PATIENT_DB_URI)
+        st.session_state["patient_snapshots"].prefetch(patient_id)
          # --- Streamlit Chat Logic ---
-        # Initialize session state for messages
-        if "messages" not in st.session_state:
-            st.session_state.messages = []
+        # Each conversation about a patient is a checkpointed agent thread, so follow-up questions
+        # continue from the earlier queries and results. The conversation id is a random id kept in
+        # the session only: it gives access to the patient conversation, so it must never appear in
+        # a URL (shared links, browser history, proxy logs).
+        from checkpoint_utilities import conversation_thread_id, get_checkpointer, load_history
+        if "conversation_id" not in st.session_state:
+            st.session_state["conversation_id"] = uuid.uuid4().hex
+        thread_id = conversation_thread_id(st.session_state["conversation_id"], patient_id)
+        checkpointer = get_checkpointer(CHECKPOINT_PATH, retention=CHECKPOINT_RETENTION_SECONDS)
+        # Only a recent window of the chat is loaded and rendered; the full conversation stays in the checkpoint
+        histories = st.session_state.setdefault("histories", {})
+        if thread_id not in histories:
+            messages, total = load_history(checkpointer, thread_id, HISTORY_WINDOW)
+            histories[thread_id] = {"messages": messages, "total": total}
+        history = histories[thread_id]
+        if st.sidebar.button("Delete this conversation", help="Remove the conversation about this patient from the server."):
+            checkpointer.delete_thread(thread_id)
+            histories.pop(thread_id, None)
+            st.session_state["conversation_id"] = uuid.uuid4().hex
+            st.rerun()
     if not option:
         st.info("Please select a patient to continue.")
         st.stop()
         
     # Display existing messages
     # Removed custom column layout as st.chat_message handles alignment and avatars
-    for message in st.session_state.messages:
+    if history["total"] > len(history["messages"]):
+        st.caption(f"{history['total'] - len(history['messages'])} earlier messages are not shown.")
+    for message in history["messages"]:
         with st.chat_message(message["role"], avatar="🧑‍💻" if message["role"] == "user" else "🤖"):
             st.markdown(message["content"])
 
@@ -113,26 +227,21 @@ def main():
     if user_input_data:
         user_query = None
         session_id = _get_session()
-        ts = int(time.time())
+        # Every step of this chat turn (transcription, agent, synthesis) is traced under one id
+        trace_id = uuid.uuid4().hex
         # Handle text input
         if "text" in user_input_data and user_input_data["text"]:
             user_query = user_input_data["text"]
         
         # Handle audio input
         elif "audioFile" in user_input_data and user_input_data["audioFile"]:
-            with st.spinner("Transcribing audio..."):
+            with st.spinner("Transcribing audio..."), tracer.trace(trace_id):
                 audio_file_bytes = user_input_data["audioFile"]
-                # Streamlit's file_uploader gives bytes, need to save to a temp file for GenAI API
-                # Use a more robust temporary file naming (e.g., uuid or time-based) for real apps
-                temp_audio_path = f"audio/temp_audio_input_{session_id}_{ts}.wav" 
-                
                 try:
-                    with open(temp_audio_path, "wb") as f:
-                        f.write(bytes(audio_file_bytes))
-                    f.close()
-                    # Call transcribe_audio with the client instance and temp file path
+                    # The audio is sent from memory (downsampled to 16 kHz mono) instead of via a temp file
                     # Assuming the widget provides WAV, specify mime_type accordingly
-                    user_query = transcribe_audio(genai_client, temp_audio_path, mime_type='audio/wav')
+                    user_query = transcribe_audio(genai_client, bytes(audio_file_bytes), mime_type='audio/wav',
+                                                  show_debug=show_debug, reencode="wav16k")
                     if show_debug:
                         st.write(f"Transcribed audio to: {user_query}")
                 except Exception as e:
@@ -140,43 +249,75 @@ def main():
                     if show_debug:
                         st.exception(e)
                     user_query = None # Clear query if transcription fails
-                # finally:
-                #     if os.path.exists(temp_audio_path):
-                #         os.remove(temp_audio_path) # Clean up the temporary file
 
         # If a valid user_query was obtained (from text or successful transcription)
         
         if user_query:
             # Add user message to chat history and display it
-            st.session_state.messages.append({"role": "user", "content": user_query})
+            remember_message(history, "user", user_query)
             # Display user message immediately (optional, but good UX)
             with st.chat_message("user", avatar="🧑‍💻"):
                 st.markdown(user_query)
                 
             # Generate response from the AI assistant
             
-            database_agent = DatabaseAgent(patient_id, GOOGLE_API_KEY, user_query)
-            assistant_response = database_agent.create_agent()
-            # Get assistant response and display it
-            with st.chat_message("assistant", avatar="🤖"):
-                with st.spinner("Thinking..."):
-                    # Call respond_user with the client instance and user query
-                    # output_audio_path = f"audio/temp_audio_output_{session_id}_{ts}.wav"
-                    output_audio_path = f"audio/temp_audio_output_{session_id}_{ts}.mp3"
-                    synthesized_audio = synthesize_speech(polly_client=polly_client,
-                                                          text=assistant_response)
-
-                    save_audio_file(synthesized_audio, output_audio_path)
-                    # asyncio.run(output_audio(groq_client, assistant_response, output_audio_path))
-                    st.markdown(assistant_response)
+            from agent_utilities import DatabaseAgent
+            # The agent graph is compiled once per process and reused for every question/patient
+            database_agent = DatabaseAgent(gemini_key=GOOGLE_API_KEY, db_uri=PATIENT_DB_URI, debug=show_debug,
+                                           checkpointer=checkpointer)
+            # Get assistant response and display it as it is generated
+            with st.chat_message("assistant", avatar="🤖"), tracer.trace(trace_id):
+                status = st.status("Thinking...")
+                answer_placeholder = st.empty()
+                streamed_text, streamed_id, assistant_response = "", None, None
+                # Sentences are synthesized in the background while the answer is still streaming
+                speech = SpeechPipeline(polly_client, cache=get_speech_cache())
+                # Use the prefetched snapshot if it is ready; the agent falls back to SQL when it can't answer
+                snapshot = st.session_state["patient_snapshots"].get(patient_id)
+                # Questions from every session run on the shared executor, limited per API key
+                events = get_question_executor().stream(
+                    GOOGLE_API_KEY, lambda: database_agent.astream(user_query, patient_id, trace_id=trace_id, snapshot=snapshot,
+                                                                 thread_id=thread_id),
+                    timeout=30)
+                try:
+                    for event in events:
+                        if event["type"] == "node":
+                            status.update(label=NODE_STATUS_LABELS.get(event["node"], "Thinking..."))
+                        elif event["type"] == "token":
+                            # A new message replaces the text of the previous one (e.g. text before a tool call)
+                            if event["message_id"] != streamed_id:
+                                streamed_text, streamed_id = "", event["message_id"]
+                                speech.reset()
+                            streamed_text += event["text"]
+                            speech.feed(event["text"])
+                            answer_placeholder.markdown(streamed_text + "▌")
+                        elif event["type"] == "final":
+                            assistant_response = event["text"]
+                except ExecutorBusy:
+                    status.update(label="Busy", state="error")
+                    st.warning("The assistant is busy with other questions. Please try again in a moment.")
+                    st.stop()
+                answer_placeholder.markdown(assistant_response)
+                if streamed_text != assistant_response:
+                    # The answer was not streamed token by token (e.g. answered while routing)
+                    speech.reset()
+                    speech.feed(assistant_response or "")
+                speech.close()
+                status.update(label="Speaking...")
+                # Audio is played from memory instead of files under audio/
+                output_audio = speech.audio()
+                status.update(label="Done", state="complete")
             
             # Add assistant response to chat history
-            st.session_state.messages.append({"role": "assistant", "content": assistant_response})
+            remember_message(history, "assistant", assistant_response)
+            st.session_state["last_trace_id"] = trace_id
+            if PROMETHEUS_FILE:
+                tracer.write_prometheus(PROMETHEUS_FILE)
             
             # Play the audio 
             audio_container = st.container()
             with audio_container:
-                st.audio(output_audio_path, format="audio/mp3", autoplay=True)
+                st.audio(output_audio, format="audio/mp3", autoplay=True)
             audio_container.float(
             "display:flex;align-items:center;justify-content:center; overflow:hidden visible;flex-direction:column; position:fixed;bottom:100px;")
             html(
@@ -189,7 +330,14 @@ def main():
             </script>
             """
         )
-        
+
+    if show_debug:
+        # Start-up costs are paid once per process, the rerun time on every interaction
+        startup = ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in startup_seconds().items())
+        timing_placeholder.caption(f"Process start-up: {startup} | "
+                                   f"This rerun: {(time.perf_counter() - rerun_started) * 1000:.0f} ms")
+        with st.sidebar:
+            show_metrics(st.session_state.get("last_trace_id"))
             
 
 if __name__ == "__main__":
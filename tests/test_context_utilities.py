@@ -0,0 +1,43 @@
+from langchain_core.messages import AIMessage, HumanMessage, RemoveMessage, ToolMessage
+from context_utilities import context_tokens, has_earlier_turns, prune_messages
+
+def make_turn(index, result_chars=2000):
+    call = {"name": "sql_db_query", "args": {"query": f"SELECT {index}"}, "id": f"call_{index}", "type": "tool_call"}
+    return [
+        HumanMessage(f"question {index}", id=f"human_{index}"),
+        AIMessage("list_tables", id=f"route_{index}"),
+        AIMessage("", tool_calls=[call], id=f"call_message_{index}"),
+        ToolMessage("x" * result_chars, tool_call_id=call["id"], name="sql_db_query", id=f"result_{index}"),
+        AIMessage(f"answer {index}", id=f"answer_{index}"),
+    ]
+
+def apply(messages, replacements):
+    """Merge the replacements the way the add_messages reducer does."""
+    removed = {message.id for message in replacements if isinstance(message, RemoveMessage)}
+    stubs = {message.id: message for message in replacements if not isinstance(message, RemoveMessage)}
+    return [stubs.get(message.id, message) for message in messages if message.id not in removed]
+
+def test_long_conversations_fit_the_budget():
+    messages = [message for index in range(30) for message in make_turn(index)]
+    messages += make_turn(30)[:4]
+    replacements, tokens_before, tokens_after = prune_messages(messages, token_budget=800)
+    pruned = apply(messages, replacements)
+    assert tokens_before > 800 >= tokens_after
+    assert context_tokens(pruned) == tokens_after
+    # The current turn and its latest result are kept intact
+    assert pruned[-4:] == messages[-4:]
+    # Every remaining tool call keeps its result
+    calls = {call["id"] for message in pruned if isinstance(message, AIMessage) for call in message.tool_calls}
+    results = {message.tool_call_id for message in pruned if isinstance(message, ToolMessage)}
+    assert calls == results
+
+def test_earlier_questions_and_answers_outlive_their_queries():
+    messages = [message for index in range(3) for message in make_turn(index)] + make_turn(3)[:4]
+    replacements, _, tokens_after = prune_messages(messages, token_budget=600)
+    pruned_ids = [message.id for message in apply(messages, replacements)]
+    assert tokens_after <= 600
+    assert ["human_0", "answer_0", "human_1", "answer_1", "human_2", "answer_2"] == pruned_ids[:6]
+
+def test_follow_ups_are_detected():
+    assert not has_earlier_turns(make_turn(0))
+    assert has_earlier_turns(make_turn(0) + make_turn(1)[:1])
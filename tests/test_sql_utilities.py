@@ -0,0 +1,127 @@
+import pytest
+from sql_utilities import PlanCache, SQLValidator, has_fixed_literals, normalize_intent
+
+COLUMNS = {
+    "patients": ["patient_id", "name", "birth_date"],
+    "treatments": ["treatment_id", "patient_id", "drug", "start_date"],
+    "pathology": ["report_id", "patient_id", "diagnosis"],
+    "drugs": ["drug", "description"],
+}
+
+@pytest.fixture
+def validator():
+    return SQLValidator("sqlite", COLUMNS, top_k=100)
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM treatments WHERE patient_id = 143",
+    "SELECT * FROM treatments WHERE patient_id = '143' AND drug = 'aspirin'",
+    "SELECT * FROM treatments WHERE 143 = patient_id",
+    "SELECT * FROM treatments t WHERE t.patient_id = 143 AND (t.drug = 'a' OR t.drug = 'b')",
+    "SELECT * FROM treatments WHERE patient_id IN (143)",
+    "SELECT * FROM treatments WHERE patient_id IN (143, '143')",
+    "SELECT * FROM treatments WHERE (patient_id = 143) AND start_date BETWEEN '2024-01-01' AND '2024-12-31'",
+    "SELECT t.drug, p.diagnosis FROM treatments t JOIN pathology p ON p.patient_id = t.patient_id WHERE t.patient_id = 143",
+    "SELECT * FROM treatments JOIN pathology USING (patient_id) WHERE patient_id = 143",
+    "SELECT t.drug, d.description FROM treatments t JOIN drugs d ON d.drug = t.drug WHERE t.patient_id = 143",
+    "SELECT drug FROM treatments WHERE patient_id = 143 UNION ALL SELECT diagnosis FROM pathology WHERE patient_id = 143",
+    "SELECT * FROM treatments WHERE patient_id = 143 AND drug IN (SELECT drug FROM treatments WHERE patient_id = 143)",
+    "SELECT * FROM (SELECT * FROM treatments WHERE patient_id = 143) recent ORDER BY start_date DESC",
+    "WITH recent AS (SELECT * FROM treatments WHERE patient_id = 143) SELECT * FROM recent",
+    "SELECT COUNT(*) FROM `treatments` WHERE `patient_id` = 143",
+    # Correlated subquery joined to the filtered outer table ("latest treatment")
+    "SELECT t1.drug FROM treatments t1 WHERE t1.patient_id = 143 AND NOT EXISTS "
+    "(SELECT 1 FROM treatments t2 WHERE t2.patient_id = t1.patient_id AND t2.start_date > t1.start_date)",
+    "SELECT p.name, (SELECT COUNT(*) FROM pathology r WHERE r.patient_id = p.patient_id) FROM patients p "
+    "WHERE p.patient_id = 143",
+])
+def test_patient_scoped_queries_pass(validator, sql):
+    result = validator.validate(sql, patient_id=143)
+    assert result.ok, result.errors
+
+@pytest.mark.parametrize("sql", [
+    # Top-level OR lets every row through
+    "SELECT * FROM treatments WHERE patient_id = 143 OR 1=1",
+    "SELECT * FROM treatments WHERE patient_id <> 143 OR patient_id = 143",
+    "SELECT * FROM treatments WHERE drug = 'a' AND patient_id = 143 OR drug = 'b'",
+    "SELECT * FROM treatments WHERE patient_id = 143 || 1",
+    # Each UNION branch is scoped on its own
+    "SELECT drug FROM treatments WHERE patient_id = 143 UNION ALL SELECT drug FROM treatments",
+    "SELECT drug FROM treatments WHERE patient_id = 143 UNION SELECT diagnosis FROM pathology WHERE patient_id = 144",
+    # IN lists may only hold the patient
+    "SELECT * FROM treatments WHERE patient_id IN (143, 144)",
+    "SELECT * FROM treatments WHERE patient_id IN (144)",
+    # Not a plain equality on the patient
+    "SELECT * FROM treatments WHERE patient_id = 1430",
+    "SELECT * FROM treatments WHERE NOT patient_id = 143",
+    "SELECT * FROM treatments WHERE patient_id = 143 = 0",
+    "SELECT * FROM treatments",
+    # Subqueries reading a patient table are scoped too
+    "SELECT * FROM treatments WHERE patient_id = 143 AND drug IN (SELECT drug FROM treatments)",
+    "SELECT * FROM patients WHERE patient_id = 143 AND EXISTS (SELECT 1 FROM pathology WHERE patient_id = 144)",
+    "WITH everyone AS (SELECT * FROM treatments) SELECT * FROM everyone WHERE patient_id = 143 UNION SELECT * FROM everyone",
+    # Every patient table of a join has to be tied to the patient
+    "SELECT * FROM treatments t JOIN pathology p ON 1 = 1 WHERE t.patient_id = 143",
+    "SELECT * FROM treatments t, pathology p WHERE t.patient_id = 143",
+    "SELECT * FROM treatments t, (SELECT 143 AS patient_id) x WHERE x.patient_id = 143",
+    # Correlated subqueries only inherit the scope of an outer alias that is itself filtered
+    "SELECT t1.drug FROM treatments t1 WHERE t1.drug = 'a' AND patient_id = 143 AND EXISTS "
+    "(SELECT 1 FROM pathology p, treatments t3 WHERE p.patient_id = t3.patient_id)",
+    "SELECT t1.drug FROM treatments t1 WHERE t1.patient_id = 143 AND EXISTS "
+    "(SELECT 1 FROM pathology t1 WHERE t1.patient_id = t1.patient_id)",
+    "SELECT t1.drug FROM treatments t1 WHERE t1.patient_id = 143 AND EXISTS "
+    "(SELECT 1 FROM treatments t2 WHERE t2.patient_id = t1.patient_id OR 1 = 1)",
+])
+def test_patient_scope_bypasses_are_rejected(validator, sql):
+    result = validator.validate(sql, patient_id=143)
+    assert not result.ok
+    assert "The query must filter on patient_id = 143." in result.errors
+
+@pytest.mark.parametrize("sql", [
+    "SELECT drug FROM treatments WHERE patient_id = 143 AND EXTRACT(YEAR FROM start_date) = 2024",
+    "SELECT TRIM(LEADING ' ' FROM name) FROM patients WHERE patient_id = 143",
+    "SELECT drug FROM treatments WHERE patient_id = 143 AND drug IN (SELECT drug FROM drugs WHERE TRIM(BOTH FROM description) <> '')",
+])
+def test_from_inside_function_calls_is_not_a_table(sql):
+    result = SQLValidator("mysql", COLUMNS, top_k=100).validate(sql, patient_id=143)
+    assert result.ok, result.errors
+
+def test_unknown_tables_in_subqueries_are_still_caught(validator):
+    result = validator.validate("SELECT * FROM treatments WHERE patient_id = 143 AND drug IN (SELECT drug FROM medicines)",
+                                patient_id=143)
+    assert "Unknown table: medicines." in result.errors
+
+@pytest.mark.parametrize("sql, expected", [
+    ("SELECT * FROM treatments WHERE patient_id = 143", "SELECT * FROM treatments WHERE patient_id = 143 LIMIT 100"),
+    ("SELECT * FROM treatments WHERE patient_id = 143 LIMIT 5", "SELECT * FROM treatments WHERE patient_id = 143 LIMIT 5"),
+    ("SELECT * FROM treatments WHERE patient_id = 143 LIMIT 1000", "SELECT * FROM treatments WHERE patient_id = 143 LIMIT 100"),
+    ("SELECT * FROM treatments WHERE patient_id = 143 LIMIT 5, 1000", "SELECT * FROM treatments WHERE patient_id = 143 LIMIT 5, 100"),
+    ("SELECT * FROM treatments WHERE patient_id = 143 LIMIT 1000 OFFSET 5",
+     "SELECT * FROM treatments WHERE patient_id = 143 LIMIT 100 OFFSET 5"),
+    ("SELECT * FROM treatments WHERE patient_id = 143 LIMIT ALL OFFSET 5",
+     "SELECT * FROM treatments WHERE patient_id = 143 LIMIT 100 OFFSET 5"),
+])
+def test_limit_is_clamped_without_losing_the_offset(validator, sql, expected):
+    assert validator.validate(sql, patient_id=143).sql == expected
+
+def test_patient_scope_without_known_columns():
+    validator = SQLValidator("sqlite", top_k=100)
+    assert validator.validate("SELECT * FROM anything WHERE patient_id = 143", patient_id=143).ok
+    assert not validator.validate("SELECT * FROM anything WHERE patient_id = 143 OR 1=1", patient_id=143).ok
+
+def test_intent_keeps_numbers_and_quoted_terms():
+    assert normalize_intent("Last 5 treatments of patient 143", patient_id=143) != normalize_intent("Last 50 treatments")
+    assert normalize_intent("Was 'aspirin' prescribed?") != normalize_intent("Was 'ibuprofen' prescribed?")
+    assert normalize_intent("What treatments has the patient had recently?") == normalize_intent("recent treatment")
+
+def test_intent_ignores_possessive_apostrophes():
+    assert normalize_intent("What is the patient's doctor's phone?") == "doctor phone"
+    assert normalize_intent("What is the patient's doctor's phone?") == normalize_intent("doctor phone")
+
+def test_plans_with_fixed_literals_are_not_cached():
+    assert not has_fixed_literals("SELECT * FROM treatments WHERE patient_id = :patient_id LIMIT 5 OFFSET 10")
+    assert has_fixed_literals("SELECT * FROM treatments WHERE patient_id = :patient_id AND start_date > '2024-01-01'")
+    cache = PlanCache()
+    assert not cache.put("treatments with a dose above 5", "SELECT * FROM treatments WHERE patient_id = 143 AND dose > 5", 143)
+    assert cache.put("last 5 treatments", "SELECT * FROM treatments WHERE patient_id = 143 LIMIT 5", 143)
+    assert cache.get("last 5 treatments", 144) is not None
+    assert cache.get("last 50 treatments", 144) is None